@@ -0,0 +1,115 @@
+# -----------------------------------------------------------------
+# 回答キャッシュ（全セッション・全プロセスで共有）
+# 同じ資料・モード・対象年齢で、同じボタン（キーワード・深掘りの問いかけ）が押されたときは
+# 以前の回答をそのまま返し、Gemini への問い合わせを省く。
+# -----------------------------------------------------------------
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+
+import storage
+from storage import CACHE_DIR
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    segments TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access);
+""" + storage.STATS_SCHEMA
+
+
+def normalize_question(question):
+    # 全角・半角、空白、文末の記号の違いは同じ質問として扱う
+    text = unicodedata.normalize("NFKC", question).strip().lower()
+    text = re.sub(r'\s+', ' ', text)
+    return text.rstrip("。.?？!！ ")
+
+
+def keyword_bucket(known_keywords, question):
+    # 既知キーワードの集合は生徒ごとに違うため、そのままでは一致しない。
+    # 回答に影響しやすい「質問に含まれる既知キーワード」と、既知キーワード数の段階だけを使う
+    in_question = sorted({kw for kw in known_keywords if kw and kw in question})
+    size = len(known_keywords)
+    level = 0 if size == 0 else 1 if size < 5 else 2 if size < 15 else 3
+    return {"level": level, "in_question": in_question}
+
+
+def make_key(document_hash, mode, target_age, question, known_keywords=()):
+    # document_hash は資料本文の sha256（document_store.content_hash）
+    payload = json.dumps(
+        [document_hash, mode, target_age, normalize_question(question), keyword_bucket(known_keywords, question)],
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    def __init__(self, path=os.path.join(CACHE_DIR, "answers.sqlite3"), ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return storage.connect(self.path, autocommit=True)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT content, segments FROM answers WHERE key = ? AND created_at > ?", (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                storage.count(conn, misses=1)
+                return None
+            conn.execute("UPDATE answers SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            storage.count(conn, hits=1)
+        return {"content": row[0], "segments": json.loads(row[1])}
+
+    def contains(self, key):
+        # 統計に数えずに、有効な回答があるかだけを調べる
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM answers WHERE key = ? AND created_at > ?", (key, time.time() - self.ttl_seconds)
+            ).fetchone()
+        return row is not None
+
+    def put(self, key, content, segments):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, content, segments, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, content, json.dumps(segments, ensure_ascii=False), now, now),
+            )
+            # 期限切れを消し、件数の上限を超えた分は最後に使われた時刻が古いものから消す
+            conn.execute("DELETE FROM answers WHERE created_at <= ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def skipped(self):
+        with self._connect() as conn:
+            storage.count(conn, bypassed=1)
+
+    def stats(self):
+        with self._connect() as conn:
+            counters = storage.counters(conn)
+            entries, = conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {
+            "hits": hits, "misses": misses, "bypassed": counters.get("bypassed", 0), "entries": entries,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
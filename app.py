@@ -2,261 +2,610 @@
 # ライブラリのインポート
 # -----------------------------------------------------------------
 import streamlit as st
-import google.generativeai as genai
+import hashlib
 import re
 import os
-import json
+import time
+import uuid
 from datetime import datetime
-import trafilatura
+import metrics
+from answer_cache import AnswerCache, make_key
+from document_store import DocumentStore, content_hash
+from history_store import HistoryStore, HISTORY_DIR, PAGE_SIZE
+from ingest import Ingestor, parse_url_list, combine_documents, DONE, FAILED
+from llm_backend import create_backend, selected_backend_name
+from llm_gateway import LLMGateway, GatewayBackend, LLMBusy, BACKGROUND
+from jobs import JobExecutor, RUNNING
+from knowledge import KnowledgeIndex, LINK_RECENT, DEFAULT_KEYWORD_TOP_K, ANONYMOUS_PREFIX
+from memory import ConversationMemory, DEFAULT_KEEP_TURNS, DEFAULT_HISTORY_BUDGET
+from page_cache import PageCache, FetchError
+from prompts import PROMPT_TEMPLATES
+from response_parser import parse_response
+from prefetch import Prefetcher, MAX_PREFETCH_PER_ANSWER
+from retrieval import estimate_tokens, DEFAULT_TOKEN_BUDGET, DEFAULT_TOP_K
+from session_backend import create_session_backend
 
 # -----------------------------------------------------------------
 # 初期設定
 # -----------------------------------------------------------------
 st.set_page_config(layout="wide", page_title="深掘り支援AI")
 
+@st.cache_resource
+def get_llm_backend():
+    # AI_TUTOR_LLM_BACKEND=fake のときは、APIを使わないローカルの代役で動かす
+    # 全セッションの呼び出しは、プロセスで1つの関所（レート制限・順番待ち・同じ呼び出しのまとめ）を通す
+    api_key = st.secrets["GEMINI_API_KEY"] if selected_backend_name() == "gemini" else None
+    return GatewayBackend(create_backend(api_key), LLMGateway.from_env())
+
 try:
-    api_key = st.secrets["GEMINI_API_KEY"]
-    genai.configure(api_key=api_key)
+    llm = get_llm_backend()
 except (KeyError, AttributeError):
     st.error("APIキーが設定されていません。.streamlit/secrets.tomlにGEMINI_API_KEYを設定してください。")
     st.stop()
 
-if not os.path.exists("history"):
-    os.makedirs("history")
+os.makedirs(HISTORY_DIR, exist_ok=True)
 
-# -----------------------------------------------------------------
-# プロンプトの定義
-# -----------------------------------------------------------------
-PROMPT_TEMPLATES = {
-    "総合家庭教師": """
-あなたは、生徒の知的好奇心を引き出すのが得意な、非常に優秀な家庭教師です。
-
-【最重要】
-生徒は以下の『参考文章』を読んでいます。あなたの回答は、必ずこの文章の内容に基づいてください。
-『参考文章』：
----
-{document_context}
----
-
-生徒からの質問に対して、必ず以下の形式で回答してください。
-回答のレベルは、対象となる {target_age} が理解できるように調整してください。
-- プロセスの説明など図解が必要な場合は、その図をMermaid記法で記述し、必ず```mermaid```と```で囲んだコードブロックにしてください。
-- 数式を記述する場合は、必ず`$$数式$$`の形式でLaTeX記法を使用してください。
-- グラフを表示する場合は、必ず```json```ブロックを使い、厳密なVega-Lite仕様のJSON形式で記述してください。
-
-【重要】
-この生徒は、以下のトピックについては既に基本的な知識があります。
-既知のトピックリスト: [{known_keywords}]
-これらのトピックの基本的な説明は省略し、今回の質問との関連性や、より発展的な内容を中心に回答してください。もしリストが空の場合は、基本的な内容から説明してください。
-
----
-### 基本的な回答
-ここに、質問に対する答えを、{target_age} にも分かるように簡潔に説明してください。
-
-### 深掘りのための問いかけ
-{target_age} が次の一歩を踏み出したくなるように、魅力的な問いかけを3つ提案してください。
-問いかけは、{target_age} の生徒の好奇心を刺激するような内容にしてください。
-
-### 参考サイト
-回答内容より詳しい情報がわかる信頼性の高いWebページへのリンクを、Markdown形式で最大5つまで提示し、簡単にそのサイトの説明をしてください。
-
-### 関連キーワード
-質生徒が興味を惹きそうな質問と回答に関連するキーワードを提示してください。明らかに生徒が知っていそうなキーワードは省略してください。
-- キーワード1
-- キーワード2
-- キーワード3
----
-
-""",
-    "科学者": """
-あなたは、複雑な科学の概念を簡単な言葉で説明するのが得意な科学者です。
-
-【最重要】
-生徒は以下の『参考文章』を読んでいます。あなたの回答は、必ずこの文章の内容に基づいてください。
-『参考文章』：
----
-{document_context}
----
-
-生徒からの質問に対して、必ず以下の形式で回答してください。
-回答のレベルは、対象となる {target_age} が理解できるように調整してください。
-- 科学的なプロセスや関係性を図解する場合は、その図をMermaid記法で記述し、必ず```mermaid```と```で囲んだコードブロックにしてください。
-- 物理法則や化学反応式を示す場合は、必ず`$$数式$$`の形式でLaTeX記法を使用してください。
-
-【重要】
-この生徒は、以下のトピックについては既に基本的な知識があります。
-既知のトピックリスト: [{known_keywords}]
-これらのトピックの基本的な説明は省略し、今回の質問との関連性や、より発展的な内容を中心に回答してください。もしリストが空の場合は、基本的な内容から説明してください。
-
----
-### ズバリ！要点はこれ
-ここに、科学的な質問に対する核心を、比喩や身近な例を使って、{target_age} にも分かるように説明してください。
-
-### 実験してみよう！
-{target_age} の知的好奇心を刺激するような、驚きのある問いかけを3つ提案してください。
-
-### 参考にしたページ
-このテーマについて、より専門的で正確な情報が得られる信頼性の高いWebページへのリンクを、Markdown形式で最大3つまで提示してください。
----
-
-### 関連する専門用語
-回答内容に関連する専門用語や、より深く知るためのキーワードを3つ提示してください。
-
-""",
-    "歴史探求家": """
-あなたは、歴史上の出来事の背景や人物像を生き生きと語るのが得意な歴史探求家です。
-
-【最重要】
-生徒は以下の『参考文章』を読んでいます。あなたの回答は、必ずこの文章の内容に基づいてください。
-『参考文章』：
----
-{document_context}
----
-
-生徒からの質問に対して、必ず以下の形式で、物語を語るように情熱的に回答してください。
-- 出来事の因果関係など、複雑な関係性を図解する場合は、その図をMermaid記法で記述し、必ず```mermaid```と```で囲んだコードブロックにしてください。
-
-【重要】
-この生徒は、以下のトピックについては既に基本的な知識があります。
-既知のトピックリスト: [{known_keywords}]
-これらのトピックの基本的な説明は省略し、今回の質問との関連性や、より発展的な内容を中心に回答してください。もしリストが空の場合は、基本的な内容から説明してください。
-
-
----
-### 物語の幕開け
-ここに、質問された歴史的出来事や人物についての基本的な情報を、魅力的な導入で語ってください。
-
-### 歴史の分岐点（What if?）
-歴史の「もしも」を想像してみたくなるような、ワクワクする問いかけを3つ提案してください。
-1. もし、あの時信長が本能寺から逃げていたら、日本の歴史はどうなっていたと思う？
-2. この出来事の裏で、教科書には載っていないどんな駆け引きがあったのか、想像してみない？
-3. この歴史から、現代の私たちが学べることは何だと思う？一緒に考えてみないかい？
-
-### 参考にしたページ
-回答の元になった、あるいは関連する資料や論文、博物館の解説ページなど、信頼できる情報源へのリンクをMarkdown形式で最大3つまで提示してください。
----
-
-### 関連キーワード
-- キーワード1
-- キーワード2
-- キーワード3
-
-"""
-}
+metrics.begin_rerun()
 
 # -----------------------------------------------------------------
 # 関数定義
 # -----------------------------------------------------------------
-@st.cache_data(ttl=3600)
+def finish_rerun():
+    save_session_state()
+    metrics.end_rerun()
+
+def rerun():
+    # st.rerun() は例外でスクリプトを抜けるため、先に状態の保存と今回の rerun の計測を済ませる
+    finish_rerun()
+    st.rerun()
+
+@st.cache_resource
+def start_metrics_server():
+    # このプロセスの全セッション分の集計を /metrics（Prometheus）と /metrics.json で公開する
+    metrics.REGISTRY.add_collector("page_cache", lambda: get_page_cache().stats())
+    metrics.REGISTRY.add_collector("answer_cache", lambda: get_answer_cache().stats())
+    metrics.REGISTRY.add_collector("prefetch", lambda: get_prefetcher().stats())
+    metrics.REGISTRY.add_collector("document_store", lambda: get_document_store().stats())
+    metrics.REGISTRY.add_collector("llm_gateway", llm.gateway.stats)
+    return metrics.start_server(metrics.METRICS_PORT)
+
+@st.cache_resource
+def get_page_cache():
+    # プロセスをまたいで共有されるディスクキャッシュ（再起動後も残る）
+    return PageCache()
+
 def get_website_text(url):
     try:
-        downloaded = trafilatura.fetch_url(url)
-        if downloaded:
-            return trafilatura.extract(downloaded, include_comments=False, include_tables=True)
-        else:
-            st.error("URLからコンテンツをダウンロードできませんでした。")
-            return None
+        text = get_page_cache().get_text(url)
+        if not text: st.error("URLから本文を取り出せませんでした。別のページを試してください。")
+        return text
+    except FetchError as e:
+        st.error(f"URLからコンテンツをダウンロードできませんでした。({e})")
+        return None
     except Exception as e:
         st.error(f"URLの処理中にエラーが発生しました: {e}")
         return None
 
+@st.cache_resource
+def get_document_store():
+    # 同じ資料を読んだセッション同士で、本文と索引を1つだけ共有する
+    return DocumentStore()
+
+def set_document(text, keep_section=False):
+    st.session_state.document = get_document_store().put(text) if text else None
+    if not keep_section: st.session_state.document_section = 0
+
+def show_document_section(number):
+    st.session_state.document_section = number
+
+@st.cache_resource
+def get_ingestor():
+    # ダウンロード用のスレッドと抽出用のプロセスは、全セッションで共有する
+    return Ingestor(get_page_cache())
+
+def cancel_ingest():
+    if st.session_state.get("ingest_batch"): st.session_state.ingest_batch.cancel()
+
+def sync_ingested_documents(batch):
+    # 読み込みが終わったページが増えていたら、資料と索引を作り直す
+    documents = batch.documents()
+    if len(documents) == st.session_state.get("ingest_applied", 0): return False
+    st.session_state.ingest_applied = len(documents)
+    # 読み込み中に資料が増えても、読んでいる節はそのまま表示する
+    set_document(combine_documents(documents), keep_section=True)
+    # まだ質問していなければ、増えた資料を含めてAI先生を作り直す
+    if not st.session_state.get("messages"): st.session_state.chat = None
+    return True
+
+def show_ingest_items(items):
+    for item in items:
+        if item["status"] == DONE:
+            st.caption(f"✅ {item['url']}（{item['elapsed']:.1f}秒）")
+        elif item["status"] == FAILED:
+            st.caption(f"⚠️ {item['url']}：{item['error']}")
+        else:
+            st.caption(f"⏳ {item['url']}")
+
+@st.fragment(run_every=1.0)
+def show_ingest_progress(batch):
+    items = batch.snapshot()
+    finished = batch.finished_count()
+    st.progress(finished / len(items), text=f"Webサイトを読み込んでいます... {finished}/{len(items)}")
+    show_ingest_items(items)
+    # ページが読み込めた時点で画面全体を更新し、途中までの資料でも質問できるようにする
+    if sync_ingested_documents(batch) or batch.is_finished():
+        rerun()
+
+@st.cache_resource
+def get_knowledge():
+    return KnowledgeIndex()
+
+def current_learner():
+    # 名前を入れたときだけ、会話をまたいだ知識ノートを使う。
+    # 名前がなければこのセッションだけのノートにし、他の生徒のキーワードが混ざらないようにする
+    name = st.session_state.get("learner_id", "").strip()
+    return name or f"{ANONYMOUS_PREFIX}{st.session_state.get('session_id', '')}"
+
+def use_learner_notes():
+    # 名前を入れたら、この会話でここまでに学んだキーワードをその学習者のノートに移す
+    if st.session_state.get("learner_id", "").strip():
+        get_knowledge().merge(current_learner(), st.session_state.get("known_keywords", {}))
+
 def add_to_known_keywords(keyword):
-    if "known_keywords" not in st.session_state: st.session_state.known_keywords = []
+    # この会話で学んだキーワード（順序つきの dict）と、学習者ごとの知識ノートの両方に記録する
+    if "known_keywords" not in st.session_state: st.session_state.known_keywords = {}
     clean_keyword = keyword.strip()
     if clean_keyword and clean_keyword not in st.session_state.known_keywords:
-        st.session_state.known_keywords.append(clean_keyword)
-
-def handle_new_question(question):
+        recent = list(st.session_state.known_keywords)[-LINK_RECENT:]
+        get_knowledge().record(current_learner(), clean_keyword, related=recent)
+        st.session_state.known_keywords[clean_keyword] = True
+
+def make_summarizer(session_id):
+    # 要約は会話とは別の、履歴を持たない呼び出しで作る。
+    # バックグラウンドのスレッドで実行するため、st.session_state には触れない
+    model = llm.model(session=session_id, priority=BACKGROUND)
+    def summarize(prompt):
+        return model.generate_content(prompt).text
+    return summarize
+
+def get_memory():
+    if "memory" not in st.session_state:
+        st.session_state.memory = ConversationMemory(
+            summarize=make_summarizer(st.session_state.get("session_id")), executor=get_job_executor(),
+        )
+    memory = st.session_state.memory
+    memory.keep_turns = st.session_state.get("memory_keep_turns", DEFAULT_KEEP_TURNS)
+    memory.token_budget = st.session_state.get("memory_token_budget", DEFAULT_HISTORY_BUDGET)
+    return memory
+
+def rebuild_chat():
+    # 保存されたメッセージから、予算内に収まるチャット履歴を毎回組み立て直す
+    with metrics.span("history_build"):
+        history = get_memory().history(st.session_state.messages)
+        st.session_state.chat = st.session_state.model.start_chat(history=history)
+
+# 既知のトピックはシステムプロンプトに入れず、質問ごとに関係するものだけを添える。
+# キーワードが増えてもAI先生（モデル）を作り直さずに済む
+KNOWN_KEYWORDS_NOTE = "質問ごとに『既知のトピック』として示します。示されていない場合は空です"
+
+def relevant_keywords(question):
+    document = st.session_state.document
+    return get_knowledge().relevant(
+        current_learner(), question,
+        document_terms=document.index.idf if document else None,
+        top_k=st.session_state.get("keyword_top_k", DEFAULT_KEYWORD_TOP_K),
+    )
+
+def build_turn_message(question):
+    parts = []
+    keywords = relevant_keywords(question)
+    if keywords: parts.append(f"『既知のトピック』：[{', '.join(keywords)}]")
+    # 長い資料はシステムプロンプトに全文を入れず、質問に関連する部分だけを毎回添える
+    if st.session_state.get("chat_uses_retrieval"):
+        with metrics.span("retrieval"):
+            excerpt = st.session_state.document.index.select_context(
+                question,
+                top_k=st.session_state.get("context_top_k", DEFAULT_TOP_K),
+                token_budget=st.session_state.get("context_token_budget", DEFAULT_TOKEN_BUDGET),
+            )
+        parts.append(f"『参考文章（質問に関連する部分の抜粋）』：\n---\n{excerpt}\n---")
+    if not parts: return question
+    return "\n\n".join(parts) + f"\n\n質問：{question}"
+
+def last_section_start(text):
+    # 最後の「###」見出しはまだ書きかけの可能性があるため、その直前までを確定部分とみなす
+    starts = [m.start() for m in re.finditer(r'^### ', text, flags=re.MULTILINE)]
+    return starts[-1] if starts else 0
+
+def stream_model_response(response, message_index):
+    completed_area = st.container()
+    pending_area = st.empty()
+    text, rendered_upto, first_token_at = "", 0, None
+    for chunk in response:
+        try:
+            chunk_text = chunk.text
+        except ValueError:
+            continue
+        if first_token_at is None: first_token_at = time.perf_counter()
+        text += chunk_text
+        # 見出し単位で確定したセクションだけをボタン付きで描画する（回答が終わるまでは押せない）
+        completed_end = last_section_start(text)
+        if completed_end > rendered_upto:
+            with completed_area:
+                render_model_response(text[rendered_upto:completed_end], message_index, disabled=True)
+            rendered_upto = completed_end
+        pending_area.markdown(text[rendered_upto:])
+    pending_area.empty()
+    with completed_area:
+        render_model_response(text[rendered_upto:], message_index, disabled=True)
+    # ボタンは、回答を保存したあとの再描画で押せるようになる
+    return text, first_token_at
+
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache()
+
+def answer_cache_key(question):
+    document = st.session_state.document
+    return make_key(
+        document.digest if document else content_hash(""), st.session_state.selected_mode, st.session_state.target_age,
+        question, relevant_keywords(question),
+    )
+
+@st.cache_resource
+def get_prefetcher():
+    # 先読みのスレッドと全体の予算は、全セッションで共有する
+    return Prefetcher()
+
+def get_prefetch_session():
+    if "prefetch_session" not in st.session_state:
+        st.session_state.prefetch_session = get_prefetcher().session()
+    return st.session_state.prefetch_session
+
+def cancel_prefetch():
+    if "prefetch_session" in st.session_state: st.session_state.prefetch_session.cancel()
+
+def make_prefetch_call(model, contents, payload_tokens):
+    # バックグラウンドのスレッドで実行するため、st.session_state には触れない
+    def call():
+        response = model.generate_content(contents)
+        usage = getattr(response, "usage_metadata", None)
+        tokens = usage.total_token_count if usage and usage.total_token_count else payload_tokens + estimate_tokens(response.text)
+        return {"text": response.text, "tokens": tokens}
+    return call
+
+def schedule_prefetch(segments):
+    if not st.session_state.get("use_prefetch"): return
+    questions = [q for segment in segments if segment["type"] == "questions" for q in segment["items"]]
+    keywords = [f"{kw}について、もっと詳しく教えてください。" for segment in segments if segment["type"] == "keywords" for kw in segment["items"]]
+    # 問いかけとキーワードを交互に、押されそうな順に並べる
+    candidates = [q for pair in zip(questions, keywords) for q in pair] + questions[len(keywords):] + keywords[len(questions):]
+    memory = get_memory()
+    history = memory.history(st.session_state.messages)
+    session = get_prefetch_session()
+    session.start_turn()
+    # 先読みは、ほかの生徒の質問より後回しにする
+    background_model = st.session_state.model.with_priority(BACKGROUND)
+    for question in candidates[:MAX_PREFETCH_PER_ANSWER]:
+        # 共有キャッシュにすでにある回答は先読みしない
+        if st.session_state.get("use_answer_cache", True) and get_answer_cache().contains(answer_cache_key(question)): continue
+        turn_message = build_turn_message(question)
+        contents = history + [{"role": "user", "parts": [turn_message]}]
+        payload_tokens = st.session_state.system_prompt_tokens + memory.last_stats["history_tokens"] + estimate_tokens(turn_message)
+        session.submit(question, payload_tokens, make_prefetch_call(background_model, contents, payload_tokens))
+
+def show_ready_answer(content, segments, started_at, source):
+    # キャッシュや先読みで用意できている回答は、問い合わせずにそのまま表示する
+    with st.chat_message("model"):
+        render_segments(segments, len(st.session_state.messages))
+    latency = round(time.perf_counter() - started_at, 3)
+    st.session_state.messages.append({
+        "role": "model", "content": content, "segments": segments,
+        "metrics": {"ttft": latency, "latency": latency, source: True},
+    })
+
+def handle_new_question(question, from_button=False, use_cache=True):
     add_to_known_keywords(question.replace("について、もっと詳しく教えてください。", "").replace("について教えて", "").strip())
     st.session_state.messages.append({"role": "user", "content": question})
+    with st.chat_message("user"):
+        st.markdown(question)
+    started_at = time.perf_counter()
+    prefetch_session = get_prefetch_session()
+    prefetched = None
+    if from_button and use_cache:
+        with st.spinner("先読み中の回答を待っています..."):
+            prefetched = prefetch_session.take(question)
+        metrics.inc("prefetch", result="hit" if prefetched else "miss")
+    # 別の質問をしたら、残りの先読みは取り消す
+    prefetch_session.cancel()
+
+    # ボタンから生まれる定型の質問は会話の流れに左右されにくいため、回答を共有する
+    cache_key = None
+    if from_button and st.session_state.get("use_answer_cache", True):
+        cache_key = answer_cache_key(question)
+        cached = get_answer_cache().get(cache_key) if use_cache else None
+        metrics.inc("answer_cache", result="hit" if cached else "bypassed" if not use_cache else "miss")
+        if not use_cache:
+            get_answer_cache().skipped()
+        elif cached:
+            show_ready_answer(cached["content"], cached["segments"], started_at, "cached")
+            schedule_prefetch(cached["segments"])
+            return
+    if prefetched:
+        segments = parse_response(prefetched["text"])
+        show_ready_answer(prefetched["text"], segments, started_at, "prefetched")
+        if cache_key: get_answer_cache().put(cache_key, prefetched["text"], segments)
+        schedule_prefetch(segments)
+        return
+    # チャット履歴は、AIに問い合わせるときだけ組み立て直す（回答のない直前の質問は含まれない）
+    rebuild_chat()
+    turn_message = build_turn_message(question)
     try:
-        response = st.session_state.chat.send_message(question)
-        st.session_state.messages.append({"role": "model", "content": response.text})
+        with st.chat_message("model"), metrics.span("llm"):
+            if st.session_state.get("stream_answers", True):
+                response = st.session_state.chat.send_message(turn_message, stream=True)
+                text, first_token_at = stream_model_response(response, len(st.session_state.messages))
+            else:
+                with st.spinner("AI先生が考えています..."):
+                    response = st.session_state.chat.send_message(turn_message)
+                text, first_token_at = response.text, None
+        finished_at = time.perf_counter()
+        turn_metrics = {
+            "ttft": round((first_token_at or finished_at) - started_at, 3),
+            "latency": round(finished_at - started_at, 3),
+            "turn_tokens": estimate_tokens(turn_message),
+            "prompt_tokens": st.session_state.system_prompt_tokens + get_memory().last_stats["history_tokens"] + estimate_tokens(turn_message),
+        }
+        usage = getattr(response, "usage_metadata", None)
+        if usage and usage.prompt_token_count: turn_metrics["usage_prompt_tokens"] = usage.prompt_token_count
+        metrics.observe("llm_first_token_seconds", turn_metrics["ttft"])
+        metrics.observe_size("prompt_tokens", turn_metrics.get("usage_prompt_tokens", turn_metrics["prompt_tokens"]))
+        metrics.observe_size("response_chars", len(text))
+        segments = parse_response(text)
+        st.session_state.messages.append({"role": "model", "content": text, "segments": segments, "metrics": turn_metrics})
+        if cache_key: get_answer_cache().put(cache_key, text, segments)
+    except LLMBusy:
+        fail_turn(question, from_button, "AI先生への質問が混み合っています。少し待ってから、もう一度質問してください。")
+        return
     except Exception as e:
-        st.error(f"AIとの通信中にエラーが発生しました: {e}")
+        fail_turn(question, from_button, f"AIとの通信中にエラーが発生しました: {e}")
+        return
+    schedule_prefetch(segments)
+
+def fail_turn(question, from_button, message):
+    # 直後に rerun するため、エラーは状態に残して次の描画で表示する。
+    # 回答のない質問は会話から外し、もう一度質問できるようにする
+    if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
+        st.session_state.messages.pop()
+    st.session_state.turn_error = {"message": message, "question": question, "from_button": from_button}
+
+def retry_turn(turn_error):
+    st.session_state.retry_turn = turn_error
 
 def set_question_from_button(question, keyword):
     st.session_state.clicked_question = question
     add_to_known_keywords(keyword)
 
-def delete_history(filename):
-    filepath = os.path.join("history", filename)
-    if os.path.exists(filepath): os.remove(filepath)
-    st.toast(f"履歴「{filename}」を削除しました。")
-    if st.session_state.get("chat_session_id") == filename: del st.session_state.chat_session_id
-
-def render_text_and_buttons(text, message_index):
-    sub_parts = re.split(r'(### (?:.*?)\n(?:.|\n)*?(?=\n###|\Z))', text)
-    for sub_part in sub_parts:
-        if not sub_part.strip(): continue
-        if sub_part.strip().startswith("###"):
-            title_match = re.search(r'### (.*?)\n', sub_part)
-            title = title_match.group(1).strip() if title_match else ""
-            content = sub_part[len(title)+5:].strip()
-            st.markdown(f"#### {title}")
-
-            if "深掘り" in title or "分岐点" in title or "実験" in title:
-                questions = [q.strip() for q in content.split('\n') if q.strip()]
-                for q_text in questions:
-                    question_to_ask = re.sub(r'^\d+\.\s*', '', q_text)
-                    st.button(question_to_ask, key=f"btn_{message_index}_{q_text}", on_click=set_question_from_button, args=(question_to_ask, question_to_ask))
-            
-            elif "キーワード" in title or "登場人物" in title or "専門用語" in title:
-                keywords = [kw.strip().lstrip('*- ').strip() for kw in content.split('\n') if kw.strip()]
-                for keyword in keywords:
-                    if not keyword: continue
-                    question_to_ask = f"{keyword}について、もっと詳しく教えてください。"
-                    st.button(keyword, key=f"kw_btn_{message_index}_{keyword}", on_click=set_question_from_button, args=(question_to_ask, keyword))
-            else:
-                st.markdown(content)
-        else:
-            st.markdown(sub_part)
-
-def render_model_response(text, message_index):
-    parts = re.split(r'(```json\n.*?\n```|```mermaid\n.*?\n```|\$\$.*?\$\$)', text, flags=re.DOTALL | re.IGNORECASE)
-    for part in parts:
-        if not part.strip(): continue
-        part_lower = part.strip().lower()
-        if part_lower.startswith('```json'):
-            json_code = part.strip().lstrip('```json').rstrip('```')
-            try:
-                json_code = re.sub(r',\s*([}\]])', r'\1', json_code)
-                spec = json.loads(json_code)
-                st.vega_lite_chart(spec)
-            except json.JSONDecodeError:
-                st.error("グラフのデータ形式が正しくないため、グラフを表示できませんでした。")
-                st.code(json_code, language="json")
-        elif part_lower.startswith('```mermaid'):
-            mermaid_code = part.strip()[len("```mermaid"):].rstrip('```').strip()
-            st.markdown(f"```mermaid\n{mermaid_code}\n```")
-        elif part_lower.startswith('$$'):
-            latex_code = part.strip().strip('$$')
-            st.latex(latex_code)
-        else:
-            render_text_and_buttons(part, message_index)
-
+def regenerate_answer(question):
+    # キャッシュの回答ではなく、AI先生に改めて回答してもらう
+    st.session_state.clicked_question = question
+    st.session_state.bypass_answer_cache = True
+
+@st.cache_resource
+def get_job_executor():
+    return JobExecutor()
+
+TITLE_PROMPT = "以下は、生徒がAI先生にした質問の一覧です。この会話のトピックを要約し、ファイル名として最適な日本語のタイトルを10文字以内で提案してください。タイトルのみを返答してください。\n\n{questions}"
+DEFAULT_TITLE = "会話の要約"
+
+def suggest_title(messages):
+    # 会話のチャット履歴には触れず、質問の一覧だけを渡す別の呼び出しでタイトルを考える
+    questions = "\n".join(f"- {m['content']}" for m in messages if m["role"] == "user")[-2000:]
+    prompt = TITLE_PROMPT.format(questions=questions)
+    model = llm.model(session=st.session_state.get("session_id"), priority=BACKGROUND)
+    def call(timeout):
+        response = model.generate_content(prompt, request_options={"timeout": timeout})
+        return re.sub(r'[\\/*?:"<>|]', "", response.text.strip()) or DEFAULT_TITLE
+    return get_job_executor().submit(call, timeout=20, fallback=DEFAULT_TITLE)
+
+def use_default_title():
+    get_job_executor().forget(st.session_state.pop("title_job", None))
+    st.session_state.suggested_filename = DEFAULT_TITLE
+
+@st.fragment(run_every=1.0)
+def wait_for_title(job_id):
+    st.caption("AIがタイトルを考えています...")
+    st.button("自分で入力する", key="skip_title_suggestion", on_click=use_default_title)
+    if get_job_executor().poll(job_id)["status"] != RUNNING:
+        rerun()
+
+@st.cache_resource
+def get_history_store():
+    store = HistoryStore()
+    # 以前の形式（history/*.json）の履歴があれば、初回起動時に取り込む
+    store.import_json_dir(HISTORY_DIR)
+    return store
+
+def save_new_messages():
+    # 保存済みの会話には、新しいメッセージだけを追記する
+    conversation_id = st.session_state.get("chat_session_id")
+    if conversation_id is None: return
+    st.session_state.saved_message_count = get_history_store().append_messages(
+        conversation_id, st.session_state.messages,
+        start=st.session_state.get("saved_message_count", 0),
+        known_keywords=st.session_state.known_keywords,
+    )
+
+def load_history(conversation_id):
+    chat_data = get_history_store().load(conversation_id)
+    if chat_data is None: return
+    cancel_prefetch()
+    # 知識ノートも一緒に読み込む（学習者とセッションIDは引き継ぐ）
+    learner_id = st.session_state.get("learner_id", "")
+    session_id = st.session_state.get("session_id")
+    st.session_state.clear()
+    st.session_state.learner_id = learner_id
+    if session_id: st.session_state.session_id = session_id
+    st.session_state.messages = chat_data["messages"]
+    st.session_state.known_keywords = dict.fromkeys(chat_data["known_keywords"], True)
+    get_knowledge().merge(current_learner(), chat_data["known_keywords"])
+    st.session_state.chat_session_id = conversation_id
+    st.session_state.saved_message_count = len(chat_data["messages"])
+    st.session_state.selected_mode = chat_data["mode"]
+    if chat_data["target_age"]: st.session_state.target_age = chat_data["target_age"]
+
+@st.cache_resource
+def get_session_backend():
+    return create_session_backend()
+
+# 再接続したときや、別のプロセスに振り分けられたときに引き継ぐ状態。
+# チャットとモデルは保存せず、メッセージと要約から作り直す
+PERSISTED_KEYS = ("selected_mode", "target_age", "chat_session_id", "saved_message_count", "learner_id", "document_section")
+
+# Streamlit がブラウザごとに発行する Cookie（XSRF対策用、タブをまたいで同じ値）
+BROWSER_COOKIE = "_streamlit_xsrf"
+
+def get_session_id():
+    # URL の ?sid= はタブを見分けるだけにし、保存先のキーはブラウザの Cookie と組み合わせて作る。
+    # 再読み込みや再接続では同じ会話に戻れるが、URLを共有・コピーしても別のブラウザでは
+    # 同じ会話を読み込んだり上書きしたりしない
+    tab_id = st.query_params.get("sid")
+    if not tab_id:
+        tab_id = uuid.uuid4().hex
+        st.query_params["sid"] = tab_id
+    browser = st.context.cookies.get(BROWSER_COOKIE)
+    if not browser:
+        # ブラウザを見分けられない（XSRF対策が無効など）ときは、引き継ぎをあきらめる
+        return uuid.uuid4().hex
+    return hashlib.sha256(f"{browser}:{tab_id}".encode("utf-8")).hexdigest()
+
+def session_state_snapshot():
+    state = {key: st.session_state[key] for key in PERSISTED_KEYS if key in st.session_state}
+    # 解析結果（segments）は本文から作り直せるので保存しない
+    state["messages"] = [{key: value for key, value in m.items() if key != "segments"} for m in st.session_state.get("messages", [])]
+    state["known_keywords"] = list(st.session_state.get("known_keywords", {}))
+    document = st.session_state.get("document")
+    state["document"] = document.digest if document else None
+    if "memory" in st.session_state: state["memory"] = st.session_state.memory.snapshot()
+    return state
+
+def save_session_state():
+    backend = get_session_backend()
+    if backend is None or "session_id" not in st.session_state: return
+    document = st.session_state.get("document")
+    memory = st.session_state.get("memory")
+    # 状態が変わったときだけ書き込む
+    fingerprint = (
+        len(st.session_state.get("messages", [])), len(st.session_state.get("known_keywords", {})), document.digest if document else None,
+        memory.summarized_turns if memory else 0, *(st.session_state.get(key) for key in PERSISTED_KEYS),
+    )
+    if fingerprint == st.session_state.get("saved_state_fingerprint"): return
+    try:
+        # 資料の本文はセッションとは別に、内容のハッシュで1つだけ保存する
+        if document: backend.save_document(document.digest, document.text)
+        backend.save_session(st.session_state.session_id, session_state_snapshot())
+        st.session_state.saved_state_fingerprint = fingerprint
+    except Exception:
+        metrics.inc("session_state_errors", operation="save")
+
+def restore_session_state(session_id):
+    backend = get_session_backend()
+    try:
+        state = backend.load_session(session_id) if backend else None
+    except Exception:
+        metrics.inc("session_state_errors", operation="load")
+        state = None
+    if not state: return
+    for key in PERSISTED_KEYS:
+        if key in state: st.session_state[key] = state[key]
+    st.session_state.messages = state["messages"]
+    st.session_state.known_keywords = dict.fromkeys(state["known_keywords"], True)
+    if state.get("document"):
+        document = get_document_store().get(state["document"])
+        if document is None:
+            text = backend.load_document(state["document"])
+            document = get_document_store().put(text) if text else None
+        st.session_state.document = document
+    if state.get("memory"): get_memory().restore(state["memory"])
+
+def delete_history(conversation_id, title):
+    get_history_store().delete(conversation_id)
+    st.toast(f"履歴「{title}」を削除しました。")
+    if st.session_state.get("chat_session_id") == conversation_id: del st.session_state.chat_session_id
+
+def reset_history_page():
+    st.session_state.history_page = 0
+
+def render_segments(segments, message_index, disabled=False):
+    # disabled: 回答の途中で押すと再実行で回答が失われるため、ストリーミング中はボタンを押せなくする
+    for segment in segments:
+        kind = segment["type"]
+        if kind == "markdown":
+            st.markdown(segment["text"])
+        elif kind == "heading":
+            st.markdown(f"#### {segment['text']}")
+        elif kind == "questions":
+            for question_to_ask in segment["items"]:
+                st.button(question_to_ask, key=f"btn_{message_index}_{question_to_ask}", on_click=set_question_from_button, args=(question_to_ask, question_to_ask), disabled=disabled)
+        elif kind == "keywords":
+            for keyword in segment["items"]:
+                question_to_ask = f"{keyword}について、もっと詳しく教えてください。"
+                st.button(keyword, key=f"kw_btn_{message_index}_{keyword}", on_click=set_question_from_button, args=(question_to_ask, keyword), disabled=disabled)
+        elif kind == "vega":
+            st.vega_lite_chart(segment["spec"])
+        elif kind == "invalid_json":
+            st.error("グラフのデータ形式が正しくないため、グラフを表示できませんでした。")
+            st.code(segment["code"], language="json")
+        elif kind == "mermaid":
+            st.markdown(f"```mermaid\n{segment['code']}\n```")
+        elif kind == "latex":
+            st.latex(segment["code"])
+
+def render_model_response(text, message_index, disabled=False):
+    render_segments(parse_response(text), message_index, disabled=disabled)
+
+def render_message(message, message_index):
+    # 解析結果を持たない古い履歴は、初回表示時に一度だけ解析して保持する
+    if "segments" not in message:
+        message["segments"] = parse_response(message["content"])
+    render_segments(message["segments"], message_index)
 
 
 # -----------------------------------------------------------------
 # セッション状態の初期化
 # -----------------------------------------------------------------
+if metrics.METRICS_PORT: start_metrics_server()
+# このプロセスで初めて見るセッションなら、保存先から状態を読み込む（再接続・別プロセスからの引き継ぎ）
+if "session_id" not in st.session_state:
+    st.session_state.session_id = get_session_id()
+    restore_session_state(st.session_state.session_id)
 if "messages" not in st.session_state: st.session_state.messages = []
 if "selected_mode" not in st.session_state: st.session_state.selected_mode = "総合家庭教師"
 if "target_age" not in st.session_state: st.session_state.target_age = "中学生"
-if "known_keywords" not in st.session_state: st.session_state.known_keywords = []
-if "document_context" not in st.session_state: st.session_state.document_context = ""
+if "known_keywords" not in st.session_state: st.session_state.known_keywords = {}
+if "document" not in st.session_state: st.session_state.document = None
 
 # -----------------------------------------------------------------
 # サイドバー
 # -----------------------------------------------------------------
 with st.sidebar:
     if st.button("新しい会話を始める", use_container_width=True):
-        keys_to_clear = ["messages", "chat", "chat_session_id", "document_context"]
+        cancel_ingest()
+        # 先読みは取り消すだけにして、セッションごとの予算の使用量は新しい会話にも引き継ぐ
+        cancel_prefetch()
+        keys_to_clear = ["messages", "chat", "chat_session_id", "document", "document_section", "ingest_batch", "ingest_applied", "memory"]
         for key in keys_to_clear:
             if key in st.session_state: del st.session_state[key]
-        st.rerun()
+        st.session_state.messages = []
+        rerun()
     st.markdown("---")
     st.subheader("設定")
+    st.toggle("回答を逐次表示する", value=True, key="stream_answers")
+    st.toggle("資料の関連部分だけをAIに送る", value=True, key="use_retrieval", help="新しい会話から反映されます")
+    st.number_input("資料の最大トークン数（1回の質問あたり）", min_value=500, max_value=30000, value=DEFAULT_TOKEN_BUDGET, step=500, key="context_token_budget")
+    st.slider("資料から取り出す部分の数", min_value=1, max_value=10, value=DEFAULT_TOP_K, key="context_top_k")
+    st.slider("そのまま覚えておく直近のやりとり数", min_value=1, max_value=20, value=DEFAULT_KEEP_TURNS, key="memory_keep_turns", help="これより古いやりとりは要約して覚えます")
+    st.number_input("会話履歴の最大トークン数", min_value=1000, max_value=100000, value=DEFAULT_HISTORY_BUDGET, step=1000, key="memory_token_budget")
     current_mode = st.session_state.selected_mode
     selected_mode = st.selectbox("AI先生の役割", list(PROMPT_TEMPLATES.keys()), index=list(PROMPT_TEMPLATES.keys()).index(current_mode))
     age_options = ["小学生（低学年）", "小学生（高学年）", "中学生", "高校生", "社会人・専門家"]
@@ -268,8 +617,9 @@ with st.sidebar:
         st.session_state.target_age = selected_age
         st.session_state.messages = []
         st.session_state.chat = None
+        cancel_prefetch()
         if "chat_session_id" in st.session_state: del st.session_state.chat_session_id
-        st.rerun()
+        rerun()
 
     # モードまたは年齢が変更されたら、会話のみをリセット
     if st.session_state.get("selected_mode") != selected_mode or st.session_state.get("target_age") != selected_age:
@@ -278,34 +628,82 @@ with st.sidebar:
         # 知識ノートはリセットしない
         st.session_state.messages = []
         st.session_state.chat = None
+        cancel_prefetch()
         if "chat_session_id" in st.session_state: del st.session_state.chat_session_id
-        st.rerun()
+        rerun()
 
     st.markdown("---")
     st.subheader("会話履歴")
-    history_files = sorted([f for f in os.listdir("history") if f.endswith(".json")], reverse=True)
+    history_query = st.text_input("履歴を検索", key="history_query", placeholder="タイトル・モード", on_change=reset_history_page)
+    history_page = st.session_state.setdefault("history_page", 0)
+    with metrics.span("history_scan"):
+        history_total = get_history_store().count(history_query)
+        history_rows = get_history_store().list(history_query, limit=PAGE_SIZE, offset=history_page * PAGE_SIZE)
 
-    if not history_files:
+    if not history_rows:
         st.write("保存された会話はありません。")
     
-    for filename in history_files:
+    for row in history_rows:
         col1, col2 = st.columns([0.8, 0.2])
         with col1:
-            if st.button(filename, key=f"load_{filename}", use_container_width=True):
-                with open(os.path.join("history", filename), "r", encoding="utf-8") as f: chat_data = json.load(f)
-                # 知識ノートも一緒に読み込む
-                st.session_state.clear()
-                st.session_state.messages = chat_data.get("messages", [])
-                st.session_state.known_keywords = chat_data.get("known_keywords", [])
-                st.session_state.chat_session_id = filename
-                st.session_state.selected_mode = chat_data.get("mode", "総合家庭教師")
-                st.rerun()
-        with col2: st.button("🗑️", key=f"delete_{filename}", on_click=delete_history, args=(filename,), use_container_width=True, help="この履歴を削除")
+            if st.button(row["title"], key=f"load_{row['id']}", use_container_width=True):
+                load_history(row["id"])
+                rerun()
+            updated_at = datetime.fromtimestamp(row["updated_at"]).strftime("%Y/%m/%d %H:%M")
+            st.caption(f"{row['mode']}・{row['target_age'] or '-'}・{row['message_count']}件・{updated_at}")
+        with col2: st.button("🗑️", key=f"delete_{row['id']}", on_click=delete_history, args=(row["id"], row["title"]), use_container_width=True, help="この履歴を削除")
+
+    page_count = max(1, -(-history_total // PAGE_SIZE))
+    if page_count > 1:
+        col1, col2, col3 = st.columns([0.3, 0.4, 0.3])
+        with col1:
+            if st.button("◀", key="history_prev", disabled=history_page == 0, use_container_width=True):
+                st.session_state.history_page -= 1
+                rerun()
+        with col2: st.caption(f"{history_page + 1} / {page_count}ページ")
+        with col3:
+            if st.button("▶", key="history_next", disabled=history_page + 1 >= page_count, use_container_width=True):
+                st.session_state.history_page += 1
+                rerun()
     
+    st.markdown("---")
+    st.toggle("同じ質問の回答を共有する", value=True, key="use_answer_cache", help="キーワードや問いかけのボタンで、他の生徒への回答を再利用します")
+    st.toggle("次の質問を先読みする", value=False, key="use_prefetch", help="回答のあと、押されそうなボタンの回答を先に作っておきます")
+    with st.expander("キャッシュ"):
+        prefetch_stats = get_prefetcher().stats()
+        st.caption(
+            f"先読み：実行 {prefetch_stats['submitted']} / 使われた {prefetch_stats['hits']}（{prefetch_stats['hit_rate']:.0%}）"
+            f" / 使われなかったトークン {prefetch_stats['wasted_tokens']:,}"
+        )
+        answer_stats = get_answer_cache().stats()
+        st.caption(
+            f"回答：ヒット {answer_stats['hits']} / ミス {answer_stats['misses']} / 再生成 {answer_stats['bypassed']}"
+            f"（ヒット率 {answer_stats['hit_rate']:.0%}・{answer_stats['entries']}件）"
+        )
+        cache_stats = get_page_cache().stats()
+        st.caption(
+            f"ページ：ヒット {cache_stats['hits']} / 再検証 {cache_stats['revalidated']} / ミス {cache_stats['misses']}"
+            f"（ヒット率 {cache_stats['hit_rate']:.0%}）"
+        )
+        st.caption(f"節約した転送量 {cache_stats['bytes_saved'] / 1024 / 1024:.1f}MB / 保存中 {cache_stats['pages']}ページ・{cache_stats['total_bytes'] / 1024 / 1024:.1f}MB")
+        gateway_stats = llm.gateway.stats()
+        st.caption(
+            f"AI呼び出し：{gateway_stats['calls']}回 / まとめた {gateway_stats['coalesced']} / 再試行 {gateway_stats['retries']}"
+            f" / 待ち {gateway_stats['queued_interactive'] + gateway_stats['queued_background']}件（平均 {gateway_stats['mean_wait_seconds']:.2f}秒）"
+        )
+
     st.markdown("---")
     st.subheader("知識ノート")
-    if st.session_state.known_keywords:
-        st.write(st.session_state.known_keywords)
+    st.text_input("学習者の名前", key="learner_id", on_change=use_learner_notes, placeholder="未入力のときは、この会話だけのノート", help="名前を入れると、知識ノートが学習者ごとに保存され、次の会話にも引き継がれます")
+    st.slider("質問に添える既知のトピックの数", min_value=0, max_value=30, value=DEFAULT_KEYWORD_TOP_K, key="keyword_top_k")
+    keyword_query = st.text_input("知識ノートを検索", key="keyword_query", placeholder="前方一致・あいまい検索")
+    # 全件は表示せず、最近のもの（または検索結果）だけを表示する
+    keyword_rows = get_knowledge().search(current_learner(), keyword_query, limit=20)
+    if keyword_rows:
+        st.caption(f"全{get_knowledge().count(current_learner())}件")
+        for row in keyword_rows:
+            last_seen = datetime.fromtimestamp(row["last_seen"]).strftime("%Y/%m/%d")
+            st.caption(f"{'📌 ' if row['keyword'] in st.session_state.known_keywords else ''}{row['keyword']}（{row['count']}回・{last_seen}）")
     else:
         st.write("まだありません。")
 # -----------------------------------------------------------------
@@ -318,22 +716,63 @@ if st.button("URLを読み込む"):
         with st.spinner("Webサイトを読み込んでいます..."):
             content = get_website_text(url)
             if content:
-                st.session_state.document_context = content
+                set_document(content)
                 st.session_state.messages = [] 
                 st.session_state.chat = None
+                cancel_prefetch()
+                # 読み込み中の読書リストは止める（残りのページが、この資料を上書きしないように）
+                cancel_ingest()
+                st.session_state.ingest_batch = None
                 st.success("読み込みが完了しました。")
     else:
         st.warning("URLを入力してください。")
 
+with st.expander("複数のURLをまとめて読み込む（読書リスト）"):
+    url_list = st.text_area("URLを1行に1つずつ入力してください", height=150)
+    if st.button("まとめて読み込む"):
+        urls = parse_url_list(url_list)
+        if urls:
+            cancel_ingest()
+            st.session_state.ingest_batch = get_ingestor().submit(urls)
+            st.session_state.ingest_applied = 0
+            set_document(None)
+            st.session_state.messages = []
+            st.session_state.chat = None
+            cancel_prefetch()
+        else:
+            st.warning("URLを入力してください。")
+
+    ingest_batch = st.session_state.get("ingest_batch")
+    if ingest_batch is not None:
+        sync_ingested_documents(ingest_batch)
+        if ingest_batch.is_finished():
+            items = ingest_batch.snapshot()
+            st.success(f"{sum(1 for item in items if item['status'] == DONE)}/{len(items)} ページを読み込みました。")
+            show_ingest_items(items)
+        else:
+            show_ingest_progress(ingest_batch)
+
 st.markdown("---")
 col1, col2 = st.columns([2, 1])
 
 # --- 左側：資料表示エリア ---
 with col1:
     st.subheader("読み込んだ資料")
-    if st.session_state.document_context:
-        with st.container(height=800):
-            st.markdown(st.session_state.document_context)
+    document = st.session_state.document
+    if document:
+        # 全文ではなく、目次で選んだ節（長い節は1ページ分）だけを描画して送る
+        sections = document.sections
+        if st.session_state.get("document_section", 0) >= len(sections): st.session_state.document_section = 0
+        if len(sections) > 1:
+            st.selectbox("目次", range(len(sections)), format_func=lambda i: sections[i][0], key="document_section")
+        section_number = st.session_state.get("document_section", 0)
+        with st.container(height=800), metrics.span("document_render"):
+            st.markdown(document.section_text(section_number))
+        if len(sections) > 1:
+            col_prev, col_page, col_next = st.columns([0.3, 0.4, 0.3])
+            with col_prev: st.button("◀ 前へ", key="document_prev", disabled=section_number == 0, on_click=show_document_section, args=(section_number - 1,), use_container_width=True)
+            with col_page: st.caption(f"{section_number + 1} / {len(sections)}")
+            with col_next: st.button("次へ ▶", key="document_next", disabled=section_number + 1 >= len(sections), on_click=show_document_section, args=(section_number + 1,), use_container_width=True)
     else:
         st.info("ここに、読み込んだWebサイトの内容が表示されます。")
 
@@ -344,62 +783,104 @@ with col2:
 
     if "chat" not in st.session_state or st.session_state.chat is None:
         prompt_template = PROMPT_TEMPLATES[st.session_state.selected_mode]
-        known_keywords_str = ", ".join(st.session_state.known_keywords) if st.session_state.known_keywords else "なし"
-        document_context_str = st.session_state.document_context if st.session_state.document_context else "今回はありません"
-        
-        system_prompt = prompt_template.format(
-            target_age=st.session_state.target_age,
-            known_keywords=known_keywords_str,
-            document_context=document_context_str
+        document = st.session_state.document
+        document_context_str = document.text if document else "今回はありません"
+        st.session_state.chat_uses_retrieval = bool(
+            st.session_state.use_retrieval and document
+            and document.index.total_tokens > st.session_state.context_token_budget
         )
+        if st.session_state.chat_uses_retrieval:
+            document_context_str = "資料が長いため、質問ごとに関連する部分を抜粋して、質問と一緒に示します。"
         
-        model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=system_prompt)
-        st.session_state.chat = model.start_chat(history=[])
+        with metrics.span("system_prompt"):
+            system_prompt = prompt_template.format(
+                target_age=st.session_state.target_age,
+                known_keywords=KNOWN_KEYWORDS_NOTE,
+                document_context=document_context_str
+            )
+        
+        with metrics.span("model"):
+            st.session_state.model = llm.model(system_instruction=system_prompt, session=st.session_state.session_id)
+        st.session_state.system_prompt_tokens = estimate_tokens(system_prompt)
+        rebuild_chat()
 
-    question = st.session_state.pop("clicked_question", None) or st.chat_input("資料について質問してみよう")
-    if question:
-        handle_new_question(question)
-        st.rerun()
+    clicked_question = st.session_state.pop("clicked_question", None)
+    use_answer_cache = not st.session_state.pop("bypass_answer_cache", False)
+    retrying = st.session_state.pop("retry_turn", None)
+    question = clicked_question or (retrying and retrying["question"]) or st.chat_input("資料について質問してみよう")
+    from_button = clicked_question is not None or bool(retrying and retrying["from_button"])
 
     with st.container(height=700):
-        for i, message in enumerate(st.session_state.messages):
-            with st.chat_message(message["role"]):
-                if message["role"] == "model":
-                    # ★★★ ここで、以前の多機能な表示関数を呼び出します ★★★
-                    render_model_response(message["content"], i)
-                else:
-                    st.markdown(message["content"])
+        with metrics.span("render"):
+            for i, message in enumerate(st.session_state.messages):
+                with st.chat_message(message["role"]):
+                    if message["role"] == "model":
+                        # ★★★ ここで、以前の多機能な表示関数を呼び出します ★★★
+                        render_message(message, i)
+                        if "metrics" in message:
+                            message_metrics = message["metrics"]
+                            if message_metrics.get("prefetched"):
+                                st.caption(f"先読みした回答を表示しました（{message_metrics['latency']:.2f}秒）")
+                            elif message_metrics.get("cached"):
+                                st.caption(f"共有された回答を表示しました（{message_metrics['latency']:.2f}秒）")
+                                st.button("AI先生に改めて聞く", key=f"regen_{i}", on_click=regenerate_answer, args=(st.session_state.messages[i - 1]["content"],))
+                            else:
+                                caption = f"最初の応答まで {message_metrics['ttft']:.1f}秒 / 回答完了まで {message_metrics['latency']:.1f}秒"
+                                if "usage_prompt_tokens" in message_metrics: caption += f" / 送信 {message_metrics['usage_prompt_tokens']}トークン"
+                                elif "prompt_tokens" in message_metrics: caption += f" / 送信 約{message_metrics['prompt_tokens']}トークン"
+                                st.caption(caption)
+                    else:
+                        st.markdown(message["content"])
+
+        # 前回の質問が失敗していたら、エラーともう一度質問するボタンを表示する
+        turn_error = st.session_state.pop("turn_error", None)
+        if turn_error and not question:
+            st.error(turn_error["message"])
+            st.button("もう一度質問する", key="retry_turn_btn", on_click=retry_turn, args=(turn_error,))
+
+        # 新しい質問は会話の末尾に逐次表示し、完了後に再描画する
+        if question:
+            handle_new_question(question, from_button=from_button, use_cache=use_answer_cache)
+            save_new_messages()
+            rerun()
 
 
 # --- 会話保存機能 ---
-    if st.session_state.messages:
+    if st.session_state.messages and st.session_state.get("chat_session_id") is not None:
+        st.caption("この会話は保存済みです。新しいやりとりは自動で追記されます。")
+    elif st.session_state.messages:
         if st.button("現在の会話を保存する", key="show_save_dialog_btn"):
             st.session_state.show_save_dialog = True
+            if "suggested_filename" not in st.session_state and "title_job" not in st.session_state:
+                st.session_state.title_job = suggest_title(st.session_state.messages)
         
-        if st.session_state.get("show_save_dialog"):
+        # タイトルの提案は裏で進め、届くまでの間も画面は操作できるようにする
+        if st.session_state.get("show_save_dialog") and "suggested_filename" not in st.session_state:
+            title_job = get_job_executor().poll(st.session_state.get("title_job"))
+            if title_job["status"] == RUNNING:
+                wait_for_title(st.session_state.title_job)
+            else:
+                st.session_state.suggested_filename = title_job["result"] or DEFAULT_TITLE
+                get_job_executor().forget(st.session_state.pop("title_job", None))
+
+        if st.session_state.get("show_save_dialog") and "suggested_filename" in st.session_state:
             with st.form("save_form"):
-                if "suggested_filename" not in st.session_state:
-                    with st.spinner("AIがファイル名を考えています..."):
-                        summary_prompt = "この会話のトピックを要約し、ファイル名として最適な日本語のタイトルを10文字以内で提案してください。タイトルのみを返答してください。"
-                        try:
-                            summary_response = st.session_state.chat.send_message(summary_prompt)
-                            st.session_state.suggested_filename = re.sub(r'[\\/*?:"<>|]', "", summary_response.text.strip())
-                        except Exception:
-                            st.session_state.suggested_filename = "会話の要約"
-                
-                filename_to_save = st.text_input("ファイル名", value=st.session_state.suggested_filename)
+                filename_to_save = st.text_input("タイトル", value=st.session_state.suggested_filename)
                 submitted = st.form_submit_button("確定して保存")
 
                 if submitted:
-                    filepath = os.path.join("history", f"{filename_to_save}.json")
-                    data_to_save = { "mode": st.session_state.selected_mode, "messages": st.session_state.messages }
-                    with open(filepath, "w", encoding="utf-8") as f:
-                        json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+                    st.session_state.chat_session_id = get_history_store().create(
+                        filename_to_save, st.session_state.selected_mode, st.session_state.target_age,
+                    )
+                    st.session_state.saved_message_count = 0
+                    save_new_messages()
                     
-                    st.success(f"会話を保存しました: {filename_to_save}.json")
+                    st.success(f"会話を保存しました: {filename_to_save}")
                     st.toast("✅ 保存完了！")
                     
                     del st.session_state.show_save_dialog
                     if "suggested_filename" in st.session_state:
                         del st.session_state.suggested_filename
-                    st.rerun()
\ No newline at end of file
+                    rerun()
+
+finish_rerun()
@@ -0,0 +1,101 @@
+# -----------------------------------------------------------------
+# 資料の持ち方による、セッションあたりのメモリと rerun ごとの送信量の比較
+#
+#   python benchmarks/bench_document.py
+#   python benchmarks/bench_document.py --sessions 30 --kb 400
+#
+# 「以前」は各セッションが本文と索引を自分で持ち、rerun のたびに全文を st.markdown に渡す。
+# 「共有」は document_store に1つだけ置いた本文と索引を参照し、目次で選んだ1ページ分だけを渡す。
+# -----------------------------------------------------------------
+import argparse
+import gc
+import os
+import statistics
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_store import DocumentStore
+from retrieval import DocumentIndex
+
+PARAGRAPH = "植物は光のエネルギーを使って、二酸化炭素と水からデンプンを作ります。葉緑体にはクロロフィルが含まれ、光を吸収します。"
+
+
+def build_document(target_kb):
+    sections, size, number = [], 0, 0
+    while size < target_kb * 1024:
+        number += 1
+        section = f"## 第{number}節 光合成のしくみ その{number}\n\n" + "\n\n".join(f"{PARAGRAPH}（{number}-{i}）" for i in range(12))
+        sections.append(section)
+        size += len(section.encode("utf-8"))
+    return "\n\n".join(sections)
+
+
+def fetched_copy(text):
+    # セッションごとにページを取得したときと同じく、内容が同じ別の文字列を作る
+    return text.encode("utf-8").decode("utf-8")
+
+
+class OldSession:
+    def __init__(self, text):
+        self.document_context = fetched_copy(text)
+        self.document_index = DocumentIndex(self.document_context)
+
+    def rerun_payload(self):
+        return len(self.document_context.encode("utf-8"))
+
+
+class SharedSession:
+    def __init__(self, text, store):
+        self.document = store.put(fetched_copy(text))
+        self.document.index
+        self.document_section = 0
+
+    def rerun_payload(self):
+        return len(self.document.section_text(self.document_section).encode("utf-8"))
+
+
+def measure(make_session, sessions):
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    held = [make_session() for _ in range(sessions)]
+    gc.collect()
+    per_session = (tracemalloc.get_traced_memory()[0] - baseline) / sessions
+    tracemalloc.stop()
+    return held, per_session
+
+
+def main():
+    parser = argparse.ArgumentParser(description="資料の持ち方の比較")
+    parser.add_argument("--sessions", type=int, default=30)
+    parser.add_argument("--kb", type=int, default=300, help="資料の大きさ（KB）")
+    args = parser.parse_args()
+
+    text = build_document(args.kb)
+    old_sessions, old_memory = measure(lambda: OldSession(text), args.sessions)
+    old_payload = old_sessions[0].rerun_payload()
+    del old_sessions
+
+    store = DocumentStore()
+    shared_sessions, shared_memory = measure(lambda: SharedSession(text, store), args.sessions)
+    document = shared_sessions[0].document
+    payloads = []
+    for number in range(len(document.sections)):
+        shared_sessions[0].document_section = number
+        payloads.append(shared_sessions[0].rerun_payload())
+    del document
+
+    print(f"資料 {len(text.encode('utf-8')) / 1024:.0f}KB / セッション {args.sessions} / 節・ページ {len(payloads)}\n")
+    print(f"{'':<8} {'セッションあたりのメモリ':>16} {'rerun ごとの送信量':>16}")
+    print(f"{'以前':<8} {old_memory / 1024:>14.0f}KB {old_payload / 1024:>14.1f}KB")
+    print(f"{'共有':<8} {shared_memory / 1024:>14.0f}KB {statistics.mean(payloads) / 1024:>14.1f}KB（最大 {max(payloads) / 1024:.1f}KB）")
+
+    del shared_sessions
+    gc.collect()
+    print(f"\n全セッションの終了後に残った資料: {store.stats()['documents']}件")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -----------------------------------------------------------------
+# 再描画（rerun）ごとの回答表示コストの比較
+#
+#   python benchmarks/bench_render.py
+#
+# 「毎回解析」は以前の render_model_response と同じく、rerun のたびに全メッセージを
+# 正規表現とJSONで解析し直す。「解析済み」は回答到着時に保存したセグメントを辿るだけ。
+# Streamlit の要素の送信コストはどちらも同じなので、ここでは Python 側の処理だけを測る。
+# -----------------------------------------------------------------
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_backend import fake_tutor_response
+from prompts import PROMPT_TEMPLATES
+from response_parser import parse_response
+
+SAMPLE_RESPONSE = fake_tutor_response(re.findall(r'^### (.+)$', PROMPT_TEMPLATES["総合家庭教師"], flags=re.MULTILINE), "光合成")
+
+
+def build_conversation(message_count):
+    messages = []
+    for i in range(message_count // 2):
+        messages.append({"role": "user", "content": f"質問{i}"})
+        messages.append({"role": "model", "content": SAMPLE_RESPONSE})
+    return messages
+
+
+def walk(segments):
+    # 表示処理の代わりに、各セグメントが作る要素の数を数える
+    return sum(len(s["items"]) if "items" in s else 1 for s in segments)
+
+
+def rerun_reparse(messages):
+    return sum(walk(parse_response(m["content"])) for m in messages if m["role"] == "model")
+
+
+def rerun_cached(messages):
+    return sum(walk(m["segments"]) for m in messages if m["role"] == "model")
+
+
+def measure(fn, messages, reruns):
+    timings = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        fn(messages)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main(reruns=50):
+    print(f"{'メッセージ数':>10} {'毎回解析':>12} {'解析済み':>12} {'短縮率':>8}")
+    for message_count in (50, 200):
+        messages = build_conversation(message_count)
+        for message in messages:
+            if message["role"] == "model": message["segments"] = parse_response(message["content"])
+        reparse_ms = measure(rerun_reparse, messages, reruns)
+        cached_ms = measure(rerun_cached, messages, reruns)
+        print(f"{message_count:>10} {reparse_ms:>10.2f}ms {cached_ms:>10.3f}ms {1 - cached_ms / reparse_ms:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
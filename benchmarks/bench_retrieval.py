@@ -0,0 +1,131 @@
+# -----------------------------------------------------------------
+# 全文をシステムプロンプトに入れる方式と、関連部分だけを送る方式の比較
+#
+#   python benchmarks/bench_retrieval.py                   # 合成した長文で比較
+#   python benchmarks/bench_retrieval.py --file page.txt   # 抽出済みのテキストで比較
+#   python benchmarks/bench_retrieval.py --url https://... # trafilatura で取得して比較
+#   GEMINI_API_KEY=... python benchmarks/bench_retrieval.py --live  # 実際の応答時間も測る
+# -----------------------------------------------------------------
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompts import PROMPT_TEMPLATES
+from retrieval import DocumentIndex, estimate_tokens, DEFAULT_TOKEN_BUDGET, DEFAULT_TOP_K
+
+QUESTIONS = [
+    "光合成について教えて",
+    "葉緑体はどんな働きをしていますか？",
+    "呼吸と光合成の違いは何ですか？",
+    "二酸化炭素の濃度が上がるとどうなりますか？",
+    "江戸時代の農業について教えて",
+]
+
+TOPICS = [
+    ("光合成", "植物は光のエネルギーを使って、二酸化炭素と水からデンプンなどの有機物を作ります。このとき酸素が放出されます。"),
+    ("葉緑体", "葉緑体は植物の細胞の中にある小さなつくりで、クロロフィルという緑色の色素を含み、光を吸収します。"),
+    ("呼吸", "呼吸は有機物を分解してエネルギーを取り出すはたらきで、昼も夜も行われ、酸素を使って二酸化炭素を出します。"),
+    ("気候変動", "大気中の二酸化炭素の濃度が上がると温室効果が強まり、地球全体の平均気温が上昇すると考えられています。"),
+    ("江戸時代の農業", "江戸時代には新田開発が進み、備中ぐわや千歯こきなどの農具の改良によって収穫量が大きく増えました。"),
+    ("鉄道の歴史", "日本で最初の鉄道は1872年に新橋と横浜の間に開業し、その後全国に路線が広がっていきました。"),
+]
+
+
+def synthetic_document(sections=120):
+    # Wikipedia の長い記事を想定し、複数の話題の節を繰り返し並べる
+    parts = []
+    for i in range(sections):
+        title, body = TOPICS[i % len(TOPICS)]
+        parts.append(f"## {title}（{i // len(TOPICS) + 1}）\n\n" + "\n\n".join([body] * 4))
+    return "\n\n".join(parts)
+
+
+def load_document(args):
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as f: return f.read()
+    if args.url:
+        import trafilatura
+        return trafilatura.extract(trafilatura.fetch_url(args.url), include_comments=False, include_tables=True)
+    return synthetic_document()
+
+
+def system_prompt(document_context):
+    return PROMPT_TEMPLATES["総合家庭教師"].format(target_age="中学生", known_keywords="なし", document_context=document_context)
+
+
+def build_requests(document, index, args):
+    # 各ターンでAPIに送られる内容（システムプロンプト・それまでの履歴・今回のメッセージ）を再現する
+    plans = {}
+    full_system = system_prompt(document)
+    short_system = system_prompt("資料が長いため、質問ごとに関連する部分を抜粋して、質問と一緒に示します。")
+    for name, system, make_turn in [
+        ("全文", full_system, lambda q: q),
+        ("抜粋", short_system, lambda q: f"『参考文章（質問に関連する部分の抜粋）』：\n---\n{index.select_context(q, args.top_k, args.budget)}\n---\n\n質問：{q}"),
+    ]:
+        history_tokens, rows = 0, []
+        for question in QUESTIONS:
+            started = time.perf_counter()
+            turn = make_turn(question)
+            build_ms = (time.perf_counter() - started) * 1000
+            turn_tokens = estimate_tokens(turn)
+            rows.append({"question": question, "turn": turn, "system": system, "build_ms": build_ms,
+                         "request_tokens": estimate_tokens(system) + history_tokens + turn_tokens})
+            history_tokens += turn_tokens + args.answer_tokens
+        plans[name] = rows
+    return plans
+
+
+def run_live(name, rows):
+    import google.generativeai as genai
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    chat = genai.GenerativeModel('gemini-1.5-flash', system_instruction=rows[0]["system"]).start_chat(history=[])
+    latencies = []
+    for row in rows:
+        started = time.perf_counter()
+        response = chat.send_message(row["turn"])
+        latencies.append(time.perf_counter() - started)
+        usage = getattr(response, "usage_metadata", None)
+        if usage: row["prompt_tokens"] = usage.prompt_token_count
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file")
+    parser.add_argument("--url")
+    parser.add_argument("--budget", type=int, default=DEFAULT_TOKEN_BUDGET)
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--answer-tokens", type=int, default=600, help="履歴に積まれる回答1件あたりの想定トークン数")
+    parser.add_argument("--live", action="store_true", help="GEMINI_API_KEY を使って実際の応答時間を測る")
+    args = parser.parse_args()
+
+    document = load_document(args)
+    started = time.perf_counter()
+    index = DocumentIndex(document)
+    index_ms = (time.perf_counter() - started) * 1000
+    print(f"資料: {len(document):,}文字 / 約{index.total_tokens:,}トークン / {len(index.chunks)}チャンク (索引作成 {index_ms:.1f}ms)")
+    print(f"予算: {args.budget}トークン / top-k: {args.top_k} / {len(QUESTIONS)}ターン\n")
+
+    plans = build_requests(document, index, args)
+    print(f"{'方式':<4} {'1ターン目':>10} {'最終ターン':>10} {'合計':>12} {'抜粋作成(平均)':>14}")
+    for name, rows in plans.items():
+        tokens = [r["request_tokens"] for r in rows]
+        print(f"{name:<4} {tokens[0]:>10,} {tokens[-1]:>10,} {sum(tokens):>12,} {statistics.mean(r['build_ms'] for r in rows):>12.2f}ms")
+    full_total = sum(r["request_tokens"] for r in plans["全文"])
+    excerpt_total = sum(r["request_tokens"] for r in plans["抜粋"])
+    print(f"\n送信トークン削減率: {1 - excerpt_total / full_total:.1%}")
+
+    if args.live:
+        print("\n実測（Gemini API）")
+        for name, rows in plans.items():
+            latencies = run_live(name, rows)
+            prompt_tokens = [r.get("prompt_tokens") for r in rows]
+            print(f"{name}: 平均 {statistics.mean(latencies):.2f}秒 / 最大 {max(latencies):.2f}秒 / 実トークン {prompt_tokens}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# -----------------------------------------------------------------
+# APIを使わない負荷試験
+# app.py そのものを Streamlit の AppTest で動かし、ローカルの代役（AI_TUTOR_LLM_BACKEND=fake）と、
+# ローカルのHTTPサーバーが返す合成ページを使って、多数のセッションの手順ごとの p50/p95/p99 を測る。
+#
+#   python benchmarks/load_test.py --sessions 30 --turns 4
+#   python benchmarks/load_test.py --first-token 1.0 --tokens-per-second 80   # 遅いAPIを想定
+#   python benchmarks/load_test.py --sessions 50 --rpm 60 --concurrency 4       # APIの上限に当たる場合
+#   python benchmarks/load_test.py --prefetch                                   # 先読みを有効にする
+#
+# 手順：URL読み込み → 質問 → ボタン（キーワード）→ 保存 → 履歴の読み込み
+# 各手順の時間は、ボタンや入力を操作してから app.py の1回の実行（rerun）が終わるまでの時間。
+# AppTest は1つのプロセスで同時に1つしか動かせないため、セッションは --processes 個のプロセスに分けて
+# 並行に動かす（Streamlit のプロセスを複数動かす構成に近い。キャッシュや保存先のディスクは共有される）。
+# -----------------------------------------------------------------
+import argparse
+import http.server
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "app.py")
+sys.path.insert(0, ROOT)
+
+from llm_gateway import DEFAULT_RPM, DEFAULT_CONCURRENCY
+from session_backend import encode_state
+
+QUESTIONS = ["光合成について教えて", "葉緑体はどんな働きをしていますか？", "呼吸と光合成の違いは何ですか？", "気孔はなぜ開いたり閉じたりするの？"]
+# 1回の rerun を待つ上限（遅いAPIを想定するときは長めにする）
+RUN_TIMEOUT = 300
+
+
+def synthetic_page(page_id, paragraphs=60):
+    body = "".join(
+        f"<h2>節{i}</h2><p>ページ{page_id}の{i}番目の段落です。植物は光のエネルギーを使って、二酸化炭素と水からデンプンを作ります。"
+        f"葉緑体にはクロロフィルが含まれ、光を吸収します。</p>"
+        for i in range(paragraphs)
+    )
+    return f"<html><head><title>ページ{page_id}</title></head><body><article><h1>資料{page_id}</h1>{body}</article></body></html>".encode("utf-8")
+
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        page = synthetic_page(self.path.strip("/") or "0")
+        etag = f'"{hash(page)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_page_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_app(args, workdir):
+    # app.py は設定を環境変数から読む。子プロセスにもそのまま引き継がれる
+    os.environ.update(
+        AI_TUTOR_LLM_BACKEND="fake",
+        AI_TUTOR_FAKE_FIRST_TOKEN=str(args.first_token),
+        AI_TUTOR_FAKE_TOKENS_PER_SECOND=str(args.tokens_per_second),
+        AI_TUTOR_FAKE_CHUNK_CHARS=str(args.chunk_chars),
+        AI_TUTOR_LLM_RPM=str(args.rpm),
+        AI_TUTOR_LLM_CONCURRENCY=str(args.concurrency),
+        AI_TUTOR_HISTORY_DIR=os.path.join(workdir, "history"),
+        AI_TUTOR_STATE_DIR=os.path.join(workdir, "state"),
+        AI_TUTOR_CACHE_DIR=os.path.join(workdir, "cache"),
+        # 集計を読むためだけに、空いているポートで /metrics を起動する（キャッシュや関所の統計が登録される）
+        AI_TUTOR_METRICS_PORT="0",
+    )
+
+
+class SessionDriver:
+    # 1人の生徒の操作を AppTest で再現し、操作ごとの rerun の時間を記録する
+    def __init__(self, session_id, args, base_url):
+        self.session_id = session_id
+        self.args = args
+        self.base_url = base_url
+        self.samples = defaultdict(list)
+        self.open()
+
+    def open(self):
+        # 新しいタブ（新しいセッション）で app.py を開く
+        from streamlit.testing.v1 import AppTest
+        self.at = AppTest.from_file(APP, default_timeout=RUN_TIMEOUT)
+
+    def run_app(self, step, element=None):
+        started = time.perf_counter()
+        (element or self.at).run()
+        self.samples[step].append(time.perf_counter() - started)
+        if self.at.exception:
+            raise RuntimeError(f"{step}: {self.at.exception[0].value}")
+
+    def button(self, label=None, key=None):
+        return next(b for b in self.at.button if (label is None or b.label == label) and (key is None or b.key == key))
+
+    def messages(self):
+        return self.at.session_state["messages"]
+
+    def load_url(self):
+        # クラス全員が同じ資料を読む想定で、ページの種類を絞る
+        url = f"{self.base_url}/{self.session_id % self.args.pages}"
+        next(t for t in self.at.text_input if t.label.startswith("学習したいWebサイト")).set_value(url)
+        self.run_app("url_load", self.button("URLを読み込む").click())
+
+    def record_answer(self, step):
+        answer = self.messages()[-1]
+        if answer["role"] != "model": raise RuntimeError(f"{step}: 回答がありません")
+        turn_metrics = answer.get("metrics", {})
+        if "ttft" in turn_metrics: self.samples[f"{step}_ttft"].append(turn_metrics["ttft"])
+        if "prompt_tokens" in turn_metrics: self.samples["prompt_tokens"].append(turn_metrics["prompt_tokens"])
+        for source in ("cached", "prefetched"):
+            if turn_metrics.get(source): self.samples[f"{step}_{source}"].append(turn_metrics["latency"])
+
+    def ask(self, question):
+        self.run_app("qa", self.at.chat_input[0].set_value(question))
+        self.record_answer("qa")
+
+    def click_keyword(self):
+        prefix = f"kw_btn_{len(self.messages()) - 1}_"
+        keywords = [b for b in self.at.button if b.key and b.key.startswith(prefix)]
+        if not keywords: return
+        self.run_app("click", keywords[0].click())
+        self.record_answer("click")
+
+    def save(self):
+        title = f"会話{self.session_id}"
+        started = time.perf_counter()
+        self.button(key="show_save_dialog_btn").click().run()
+        # タイトルの提案はバックグラウンドで作られるため、届くまで描画し直す
+        while not any(b.label == "確定して保存" for b in self.at.button):
+            time.sleep(0.1)
+            self.at.run()
+        next(t for t in self.at.text_input if t.label == "タイトル").set_value(title)
+        self.button("確定して保存").click().run()
+        self.samples["save"].append(time.perf_counter() - started)
+        self.conversation_id = self.at.session_state["chat_session_id"]
+
+    def load_history(self):
+        # 別のタブで開き直し、保存した会話を履歴から探して読み込む
+        self.open()
+        self.run_app("first_render")
+        self.at.text_input(key="history_query").set_value(f"会話{self.session_id}").run()
+        self.run_app("history_load", self.button(key=f"load_{self.conversation_id}").click())
+        if len(self.messages()) != self.message_count: raise RuntimeError("history_load: 会話を読み込めませんでした")
+
+    def state_size(self):
+        # app.session_state_snapshot と同じく、解析結果を除いて圧縮した大きさ
+        state = self.at.session_state
+        return len(encode_state({
+            "messages": [{k: v for k, v in m.items() if k != "segments"} for m in state["messages"]],
+            "known_keywords": list(state["known_keywords"]), "document": state["document"].digest,
+            "memory": state["memory"].snapshot() if "memory" in state else None,
+        }))
+
+    def run(self):
+        self.run_app("first_render")
+        if self.args.prefetch: self.at.toggle(key="use_prefetch").set_value(True).run()
+        self.load_url()
+        for turn in range(self.args.turns):
+            self.ask(QUESTIONS[turn % len(QUESTIONS)])
+            self.click_keyword()
+            # 操作のない rerun（ウィジェットを触ったときなど）
+            self.run_app("rerun")
+        self.state_bytes = self.state_size()
+        self.message_count = len(self.messages())
+        self.save()
+        self.load_history()
+        return self
+
+
+def run_session(session_id, args, base_url):
+    # 子プロセスで1セッションを動かす。app.py の部品（キャッシュや関所）はプロセスの中で共有される
+    import metrics
+    # AppTest は app.py を __main__ として実行する。次のセッションを受け取れるよう元に戻す
+    main_module = sys.modules["__main__"]
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        driver = SessionDriver(session_id, args, base_url).run()
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+        sys.modules["__main__"] = main_module
+    return {
+        "pid": os.getpid(), "samples": dict(driver.samples), "memory": memory, "state_size": driver.state_bytes,
+        "gauges": metrics.REGISTRY.collect(),
+    }
+
+
+def percentile_table(samples):
+    rows = []
+    for step in sorted(samples):
+        values = sorted(samples[step])
+        q = statistics.quantiles(values, n=100, method="inclusive") if len(values) > 1 else values * 99
+        rows.append((step, len(values), q[49], q[94], q[98]))
+    return rows
+
+
+# ディスク上の保存先から数える値（全プロセスで同じもの）
+SHARED_GAUGES = {"entries", "pages", "total_bytes"}
+
+
+def sum_gauges(per_process):
+    # 集計はプロセスごとなので、各プロセスの最後の値を足し合わせる（割合や平均は足せないので除く）
+    total = defaultdict(lambda: defaultdict(float))
+    for gauges in per_process.values():
+        for name, values in gauges.items():
+            for key, value in values.items():
+                if key.endswith("_rate") or key.startswith("mean_"): continue
+                total[name][key] = max(total[name][key], value) if key in SHARED_GAUGES else total[name][key] + value
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APIを使わない負荷試験")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--processes", type=int, default=min(8, os.cpu_count() or 1), help="セッションを並行に動かすプロセスの数")
+    parser.add_argument("--prefetch", action="store_true", help="次の質問の先読みを有効にする")
+    parser.add_argument("--pages", type=int, default=3, help="セッション全体で読む資料の種類")
+    parser.add_argument("--first-token", type=float, default=0.3, help="代役の最初の応答までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=400)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM, help="関所（プロセスごと）の1分あたりのリクエスト数の上限")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="関所（プロセスごと）の同時実行数")
+    args = parser.parse_args()
+
+    configure_app(args, tempfile.mkdtemp(prefix="ai-tutor-load-"))
+    server = start_page_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    samples, gauges, results = defaultdict(list), {}, []
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(run_session, i, args, base_url) for i in range(args.sessions)]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            for step, values in result["samples"].items():
+                samples[step].extend(values)
+            gauges[result["pid"]] = result["gauges"]
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    totals = sum_gauges(gauges)
+
+    print(f"セッション {args.sessions} / ターン {args.turns} / プロセス {len(gauges)} / 合計 {elapsed:.1f}秒 / LLM呼び出し {totals['llm_gateway']['calls']:.0f}回\n")
+    print(f"{'手順':<16} {'件数':>6} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for step, count, p50, p95, p99 in percentile_table(samples):
+        if step == "prompt_tokens":
+            print(f"{step:<16} {count:>6} {p50:>10.0f} {p95:>10.0f} {p99:>10.0f}")
+        else:
+            print(f"{step:<16} {count:>6} {p50 * 1000:>8.1f}ms {p95 * 1000:>8.1f}ms {p99 * 1000:>8.1f}ms")
+    memory_per_session = statistics.mean(r["memory"] for r in results)
+    state_size = statistics.mean(r["state_size"] for r in results)
+    print(f"\nセッションあたりのメモリ（tracemalloc）: {memory_per_session / 1024:.0f}KB / 保存する状態（圧縮後）: {state_size / 1024:.1f}KB")
+    for name in ("answer_cache", "page_cache", "prefetch", "llm_gateway"):
+        if name in totals: print(f"{name}: {dict(totals[name])}")
+
+
+if __name__ == "__main__":
+    main()
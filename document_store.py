@@ -0,0 +1,101 @@
+# -----------------------------------------------------------------
+# 読み込んだ資料の共有置き場（プロセス内で1つ）
+# 同じ内容の資料は内容のハッシュで1つにまとめ、各セッションは Document への参照だけを持つ。
+# 参照しているセッションがなくなった資料は、弱参照の辞書から自動的に消える。
+# 索引（DocumentIndex）も資料ごとに1回だけ作り、全セッションで使い回す。
+# -----------------------------------------------------------------
+import hashlib
+import re
+import threading
+import weakref
+
+from retrieval import DocumentIndex
+
+# 資料の表示は、この文字数を目安にページに分ける
+PAGE_CHARS = 4000
+TITLE_CHARS = 40
+
+HEADING = re.compile(r'^#{1,6}[ \t]+(.+)$', re.MULTILINE)
+
+
+def content_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def page_breaks(text, start, end, page_chars):
+    # 段落の区切り（空行）で、page_chars を超えないように分ける
+    breaks = []
+    while end - start > page_chars:
+        cut = text.rfind("\n\n", start + 1, start + page_chars)
+        if cut == -1: cut = text.rfind("\n", start + 1, start + page_chars)
+        if cut == -1: cut = start + page_chars
+        breaks.append(cut)
+        start = cut
+    return breaks
+
+
+def section_title(text, start, end):
+    line = text[start:min(end, start + 200)].strip().split("\n", 1)[0]
+    line = line.lstrip("#").strip()
+    return line[:TITLE_CHARS] + ("…" if len(line) > TITLE_CHARS else "") or "（無題）"
+
+
+def split_into_sections(text, page_chars=PAGE_CHARS):
+    # 見出し（#）ごとに節に分け、長い節はさらにページに分ける。
+    # 本文は複製せず、(見出し, 開始位置, 終了位置) だけを持つ
+    starts = [0] + [m.start() for m in HEADING.finditer(text) if m.start() > 0]
+    bounds = list(zip(starts, starts[1:] + [len(text)]))
+    sections = []
+    for start, end in bounds:
+        if not text[start:end].strip(): continue
+        title = section_title(text, start, end)
+        pieces = [start] + page_breaks(text, start, end, page_chars) + [end]
+        for page, (piece_start, piece_end) in enumerate(zip(pieces, pieces[1:])):
+            sections.append((title if page == 0 else f"{title}（{page + 1}）", piece_start, piece_end))
+    return sections
+
+
+class Document:
+    def __init__(self, text, digest):
+        self.text = text
+        self.digest = digest
+        self.sections = split_into_sections(text)
+        self._index = None
+        self._lock = threading.Lock()
+
+    def section_text(self, number):
+        _, start, end = self.sections[number]
+        return self.text[start:end]
+
+    @property
+    def index(self):
+        # 索引は最初に質問されたときに1回だけ作る
+        with self._lock:
+            if self._index is None:
+                self._index = DocumentIndex(self.text)
+            return self._index
+
+    def __bool__(self):
+        return bool(self.text)
+
+
+class DocumentStore:
+    def __init__(self):
+        self._documents = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def put(self, text):
+        digest = content_hash(text)
+        with self._lock:
+            document = self._documents.get(digest)
+            if document is None:
+                document = self._documents[digest] = Document(text, digest)
+            return document
+
+    def get(self, digest):
+        return self._documents.get(digest)
+
+    def stats(self):
+        with self._lock:
+            documents = list(self._documents.values())
+        return {"documents": len(documents), "total_chars": sum(len(d.text) for d in documents)}
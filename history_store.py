@@ -0,0 +1,184 @@
+# -----------------------------------------------------------------
+# 会話履歴の保存（SQLite）
+# 一覧表示用の情報（タイトル・モード・対象年齢・日時・件数）は conversations に、
+# メッセージ本体は messages に1件ずつ追記する。保存のたびに全体を書き直さない。
+#
+#   python history_store.py import history/   # 以前の history/*.json を取り込む
+# -----------------------------------------------------------------
+import argparse
+import json
+import os
+import time
+
+import storage
+
+# 複数のプロセス（サーバー）で共有するときは、共有ディスク上のディレクトリを指定する
+HISTORY_DIR = os.environ.get("AI_TUTOR_HISTORY_DIR", "history")
+DEFAULT_DB_PATH = os.path.join(HISTORY_DIR, "history.sqlite3")
+PAGE_SIZE = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    target_age TEXT,
+    known_keywords TEXT NOT NULL DEFAULT '[]',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    extra TEXT,
+    PRIMARY KEY (conversation_id, position)
+);
+-- 取り込み済みのJSONファイル（会話を削除しても、再び取り込まないように残す）
+CREATE TABLE IF NOT EXISTS imported_files (
+    filename TEXT PRIMARY KEY,
+    imported_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at DESC);
+"""
+
+LIST_COLUMNS = ("id", "title", "mode", "target_age", "created_at", "updated_at", "message_count")
+
+
+class HistoryStore:
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return storage.connect(self.path, foreign_keys=True)
+
+    def _search_clause(self, query):
+        if not query: return "", ()
+        escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return " WHERE title LIKE ? ESCAPE '\\' OR mode LIKE ? ESCAPE '\\'", (f"%{escaped}%",) * 2
+
+    def count(self, query=""):
+        where, params = self._search_clause(query)
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM conversations{where}", params).fetchone()[0]
+
+    def list(self, query="", limit=PAGE_SIZE, offset=0):
+        where, params = self._search_clause(query)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(LIST_COLUMNS)} FROM conversations{where} ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                params + (limit, offset),
+            ).fetchall()
+        return [dict(zip(LIST_COLUMNS, row)) for row in rows]
+
+    def _create(self, conn, title, mode, target_age, known_keywords, created_at):
+        now = created_at or time.time()
+        cursor = conn.execute(
+            "INSERT INTO conversations (title, mode, target_age, known_keywords, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (title, mode, target_age, json.dumps(list(known_keywords), ensure_ascii=False), now, now),
+        )
+        return cursor.lastrowid
+
+    def _append_messages(self, conn, conversation_id, messages, start, updated_at=None):
+        new_messages = messages[start:]
+        conn.executemany(
+            "INSERT OR REPLACE INTO messages (conversation_id, position, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+            [
+                (conversation_id, start + i, m["role"], m["content"],
+                 json.dumps({k: v for k, v in m.items() if k not in ("role", "content")}, ensure_ascii=False))
+                for i, m in enumerate(new_messages)
+            ],
+        )
+        conn.execute(
+            "UPDATE conversations SET message_count = ?, updated_at = ? WHERE id = ?",
+            (start + len(new_messages), updated_at or time.time(), conversation_id),
+        )
+        return start + len(new_messages)
+
+    def create(self, title, mode, target_age=None, known_keywords=(), created_at=None):
+        with self._connect() as conn:
+            return self._create(conn, title, mode, target_age, known_keywords, created_at)
+
+    def append_messages(self, conversation_id, messages, start=0, known_keywords=None):
+        # messages[start:] だけを書き込む（保存済みの部分は書き直さない）
+        with self._connect() as conn:
+            count = self._append_messages(conn, conversation_id, messages, start)
+            if known_keywords is not None:
+                conn.execute(
+                    "UPDATE conversations SET known_keywords = ? WHERE id = ?",
+                    (json.dumps(list(known_keywords), ensure_ascii=False), conversation_id),
+                )
+        return count
+
+    def load(self, conversation_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT title, mode, target_age, known_keywords FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None: return None
+            rows = conn.execute(
+                "SELECT role, content, extra FROM messages WHERE conversation_id = ? ORDER BY position", (conversation_id,)
+            ).fetchall()
+        messages = []
+        for role, content, extra in rows:
+            message = {"role": role, "content": content}
+            if extra: message.update(json.loads(extra))
+            messages.append(message)
+        title, mode, target_age, known_keywords = row
+        return {"title": title, "mode": mode, "target_age": target_age, "known_keywords": json.loads(known_keywords), "messages": messages}
+
+    def delete(self, conversation_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    def import_json_dir(self, directory=HISTORY_DIR):
+        # 以前の形式（1会話 = 1つのJSONファイル）を取り込む。取り込み済みのファイルは飛ばす
+        if not os.path.isdir(directory): return 0
+        with self._connect() as conn:
+            imported = {row[0] for row in conn.execute("SELECT filename FROM imported_files")}
+        count = 0
+        for filename in sorted(f for f in os.listdir(directory) if f.endswith(".json")):
+            if filename in imported: continue
+            filepath = os.path.join(directory, filename)
+            try:
+                with open(filepath, "r", encoding="utf-8") as f: chat_data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            created_at = os.path.getmtime(filepath)
+            # 複数のプロセスが同時に起動しても1回だけ取り込むよう、ファイルの確保と取り込みを1つのトランザクションで行う
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                claimed = conn.execute(
+                    "INSERT OR IGNORE INTO imported_files (filename, imported_at) VALUES (?, ?)", (filename, time.time())
+                ).rowcount
+                if not claimed: continue
+                conversation_id = self._create(
+                    conn, filename[:-len(".json")], chat_data.get("mode", "総合家庭教師"), chat_data.get("target_age"),
+                    chat_data.get("known_keywords", []), created_at,
+                )
+                self._append_messages(conn, conversation_id, chat_data.get("messages", []), 0, updated_at=created_at)
+            count += 1
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話履歴データベースの管理")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    import_parser = subcommands.add_parser("import", help="history/*.json を取り込む")
+    import_parser.add_argument("directory", nargs="?", default=HISTORY_DIR)
+    import_parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    args = parser.parse_args()
+    if args.command == "import":
+        count = HistoryStore(args.db).import_json_dir(args.directory)
+        print(f"{count}件の会話を取り込みました。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# -----------------------------------------------------------------
+# 複数URLの一括読み込み
+# ダウンロードはスレッドプール（ホストごとの同時接続数を制限）、
+# trafilatura による抽出（lxml、CPU負荷が高い）はプロセスプールで行う。
+# 1つのURLの失敗は、そのURLだけのエラーとして記録し、他のURLの処理は続ける。
+# Streamlit のサーバーはスレッドが多く、fork では他のスレッドが持っていたロックごと子プロセスに
+# 複製されて止まることがあるため、抽出のプロセスは spawn で起動する。
+# -----------------------------------------------------------------
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from page_cache import FetchError, extract_text
+
+MAX_BATCH_URLS = 30
+DOWNLOAD_WORKERS = 8
+PER_HOST_LIMIT = 2
+DOWNLOAD_TIMEOUT = 20
+EXTRACT_TIMEOUT = 60
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+
+def parse_url_list(text):
+    # 1行に1つのURL。空行・重複・# で始まるコメント行は無視する
+    urls = []
+    for line in text.splitlines():
+        url = line.strip()
+        if url and not url.startswith("#") and url not in urls:
+            urls.append(url)
+    return urls[:MAX_BATCH_URLS]
+
+
+class IngestBatch:
+    def __init__(self, urls):
+        self.urls = list(urls)
+        self._lock = threading.Lock()
+        self._items = {url: {"url": url, "status": PENDING, "text": None, "error": None, "elapsed": None} for url in self.urls}
+        self._futures = []
+
+    def track(self, futures):
+        self._futures = list(futures)
+
+    def update(self, url, **fields):
+        with self._lock:
+            self._items[url].update(fields)
+
+    def snapshot(self):
+        with self._lock:
+            return [dict(self._items[url]) for url in self.urls]
+
+    def finished_count(self):
+        with self._lock:
+            return sum(1 for item in self._items.values() if item["status"] in (DONE, FAILED))
+
+    def is_finished(self):
+        return self.finished_count() == len(self.urls)
+
+    def documents(self):
+        # 読み込みが終わったページだけを、入力された順に返す（途中経過でもすぐ使える）
+        with self._lock:
+            return [(url, self._items[url]["text"]) for url in self.urls if self._items[url]["status"] == DONE]
+
+    def cancel(self):
+        for future in self._futures:
+            future.cancel()
+
+
+def combine_documents(documents):
+    return "\n\n".join(f"# {url}\n\n{text}" for url, text in documents)
+
+
+class Ingestor:
+    def __init__(self, page_cache, download_workers=DOWNLOAD_WORKERS, per_host_limit=PER_HOST_LIMIT,
+                 extract_workers=None, download_timeout=DOWNLOAD_TIMEOUT, extract_timeout=EXTRACT_TIMEOUT):
+        self.page_cache = page_cache
+        self.download_timeout = download_timeout
+        self.extract_timeout = extract_timeout
+        self.per_host_limit = per_host_limit
+        self._downloads = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="ingest")
+        self.extract_workers = extract_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._extractors = self._new_extractor_pool()
+        self._extracting = []
+        self._pool_lock = threading.Lock()
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+
+    @contextmanager
+    def _host_slot(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._host_lock:
+            slot = self._host_slots.setdefault(host, threading.BoundedSemaphore(self.per_host_limit))
+        with slot:
+            yield
+
+    def _new_extractor_pool(self):
+        return ProcessPoolExecutor(max_workers=self.extract_workers, mp_context=get_context("spawn"))
+
+    def _recycle(self, pool):
+        # 時間切れの抽出はプロセスごと止め、以降の抽出は新しいプールで行う
+        with self._pool_lock:
+            if self._extractors is not pool: return
+            self._extractors = self._new_extractor_pool()
+            self._extracting = []
+        # ProcessPoolExecutor には実行中の子プロセスを止める公開の方法がない（3.14 の terminate_workers まで）
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _submit_extract(self, html):
+        with self._pool_lock:
+            pool = self._extractors
+            future = pool.submit(extract_text, html)
+            self._extracting = [f for f in self._extracting if not f.done()] + [future]
+        return pool, future
+
+    def _is_extracting(self, future):
+        # プールは投入された順に実行するため、自分より前の未完了の抽出が worker 数より少なければ実行中
+        # （Future.running() は子プロセスに渡す待ち行列に入った時点で True になる）
+        with self._pool_lock:
+            pending = [f for f in self._extracting if not f.done()]
+        return future in pending[:self.extract_workers]
+
+    def _extract(self, html):
+        # 抽出は別プロセスで実行し、このスレッドは結果を待つだけにする
+        for attempt in range(2):
+            try:
+                pool, future = self._submit_extract(html)
+                while True:
+                    try:
+                        return future.result(timeout=self.extract_timeout)
+                    except FutureTimeout:
+                        # 順番待ちの間は時間切れにしない
+                        if self._is_extracting(future): break
+                self._recycle(pool)
+                raise FetchError(f"本文の抽出が{self.extract_timeout}秒以内に終わりませんでした")
+            except (BrokenProcessPool, CancelledError):
+                # 別のURLの時間切れでプールが作り直された（待っていた抽出が止められた）場合は、新しいプールでやり直す
+                if attempt: raise
+
+    def _load(self, batch, url):
+        started = time.perf_counter()
+        batch.update(url, status=RUNNING)
+        try:
+            text = self.page_cache.get_text(url, extract=self._extract, timeout=self.download_timeout, fetch_slot=self._host_slot)
+            if not text:
+                raise FetchError("本文を抽出できませんでした")
+            batch.update(url, status=DONE, text=text, elapsed=time.perf_counter() - started)
+        except Exception as e:
+            batch.update(url, status=FAILED, error=str(e) or type(e).__name__, elapsed=time.perf_counter() - started)
+
+    def submit(self, urls):
+        batch = IngestBatch(urls)
+        batch.track(self._downloads.submit(self._load, batch, url) for url in batch.urls)
+        return batch
+
+    def shutdown(self):
+        self._downloads.shutdown(wait=False, cancel_futures=True)
+        self._extractors.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,70 @@
+# -----------------------------------------------------------------
+# 補助的なAI呼び出し（タイトルの提案など）のバックグラウンド実行
+# 画面の再描画を止めないよう別スレッドで実行し、画面側は結果をポーリングする。
+# 失敗したら間隔を空けて再試行し、時間切れや失敗のときは代わりの値（fallback）を返す。
+# -----------------------------------------------------------------
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from tenacity import Retrying, stop_after_attempt, stop_after_delay, wait_exponential_jitter
+
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 30
+DEFAULT_ATTEMPTS = 3
+# 結果を取りに来なかったジョブを残しておく時間
+FORGET_AFTER = 600
+
+RUNNING, DONE, FAILED, TIMEOUT = "running", "done", "failed", "timeout"
+
+
+class JobExecutor:
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _run(self, fn, timeout, attempts):
+        # 1回ごとの呼び出しには残り時間を渡し、全体として timeout を超えないようにする
+        deadline = time.monotonic() + timeout
+        for attempt in Retrying(
+            stop=stop_after_attempt(attempts) | stop_after_delay(timeout),
+            wait=wait_exponential_jitter(initial=0.5, max=8),
+            reraise=True,
+        ):
+            with attempt:
+                return fn(max(1.0, deadline - time.monotonic()))
+
+    def submit(self, fn, timeout=DEFAULT_TIMEOUT, attempts=DEFAULT_ATTEMPTS, fallback=None):
+        # fn は残り時間（秒）を受け取る関数
+        job_id = uuid.uuid4().hex
+        future = self._executor.submit(self._run, fn, timeout, attempts)
+        with self._lock:
+            self._forget_stale()
+            self._jobs[job_id] = {"future": future, "deadline": time.monotonic() + timeout, "fallback": fallback, "submitted_at": time.monotonic()}
+        return job_id
+
+    def poll(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return {"status": FAILED, "result": None}
+        future = job["future"]
+        if future.done():
+            if future.exception() is None:
+                return {"status": DONE, "result": future.result()}
+            return {"status": FAILED, "result": job["fallback"], "error": str(future.exception())}
+        if time.monotonic() > job["deadline"]:
+            return {"status": TIMEOUT, "result": job["fallback"]}
+        return {"status": RUNNING, "result": None}
+
+    def forget(self, job_id):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job: job["future"].cancel()
+
+    def _forget_stale(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self._jobs.items() if now - job["submitted_at"] > FORGET_AFTER]:
+            self._jobs.pop(job_id)["future"].cancel()
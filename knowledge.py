@@ -0,0 +1,233 @@
+# -----------------------------------------------------------------
+# 学習者ごとの知識ノート（SQLite）
+# 学んだキーワードを、最初と最後に出てきた日時・回数・一緒に学んだキーワードとのつながりとともに保存する。
+# AIには全件ではなく、今回の質問と資料に関係する上位のキーワードだけを質問と一緒に渡す。
+# キーワードは正規化した語（英数字の単語と、漢字・かなの2文字ずつ）で索引し、質問と語を共有するものだけを引く。
+# 名前のない学習者（session:<セッションID>）のノートは、しばらく使われなければ消す。
+# -----------------------------------------------------------------
+import difflib
+import os
+import time
+import unicodedata
+
+import storage
+from history_store import HISTORY_DIR
+from retrieval import tokenize
+from session_backend import DEFAULT_TTL_SECONDS as SESSION_TTL_SECONDS
+
+DEFAULT_DB_PATH = os.path.join(HISTORY_DIR, "knowledge.sqlite3")
+DEFAULT_KEYWORD_TOP_K = 10
+# 新しく学んだキーワードは、同じ会話で直前に学んだこの数のキーワードとつなげる
+LINK_RECENT = 3
+# 質問と語を共有しないキーワードは、最近使ったこの件数の中からだけ資料との関係を調べる
+RECENT_CANDIDATES = 200
+# 名前のない学習者のノートは、セッションの状態と同じ期間だけ残す（状態が消えたら、もう誰も使わない）
+ANONYMOUS_PREFIX = "session:"
+ANONYMOUS_TTL_SECONDS = SESSION_TTL_SECONDS
+# 古いノートを消すのは、記録のついでにこの間隔に1回だけ
+PURGE_INTERVAL = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keywords (
+    learner TEXT NOT NULL,
+    keyword TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    count INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (learner, keyword)
+);
+CREATE TABLE IF NOT EXISTS links (
+    learner TEXT NOT NULL,
+    keyword TEXT NOT NULL,
+    related TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (learner, keyword, related)
+);
+CREATE TABLE IF NOT EXISTS keyword_terms (
+    learner TEXT NOT NULL,
+    term TEXT NOT NULL,
+    keyword TEXT NOT NULL,
+    PRIMARY KEY (learner, term, keyword)
+);
+CREATE INDEX IF NOT EXISTS keywords_last_seen ON keywords (learner, last_seen DESC);
+"""
+
+COLUMNS = ("keyword", "first_seen", "last_seen", "count")
+
+
+def normalize(text):
+    # 全角・半角や大文字・小文字の違いをそろえる
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def keyword_terms(text):
+    return set(tokenize(normalize(text)))
+
+
+class KnowledgeIndex:
+    def __init__(self, path=DEFAULT_DB_PATH, anonymous_ttl=ANONYMOUS_TTL_SECONDS):
+        self.path = path
+        self.anonymous_ttl = anonymous_ttl
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # 索引を作る前に記録されたキーワードにも語を付ける
+            missing = conn.execute(
+                "SELECT learner, keyword FROM keywords k WHERE NOT EXISTS "
+                "(SELECT 1 FROM keyword_terms t WHERE t.learner = k.learner AND t.keyword = k.keyword)"
+            ).fetchall()
+            for learner, keyword in missing:
+                self._index_terms(conn, learner, keyword)
+        self.purge_anonymous()
+
+    def _connect(self):
+        return storage.connect(self.path)
+
+    def _index_terms(self, conn, learner, keyword):
+        conn.executemany(
+            "INSERT OR IGNORE INTO keyword_terms (learner, term, keyword) VALUES (?, ?, ?)",
+            [(learner, term, keyword) for term in keyword_terms(keyword)],
+        )
+
+    # --- 記録 ---
+    def record(self, learner, keyword, related=(), seen_at=None):
+        now = seen_at or time.time()
+        related = [r for r in related if r and r != keyword]
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO keywords (learner, keyword, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(learner, keyword) DO UPDATE SET last_seen = excluded.last_seen, count = count + 1",
+                (learner, keyword, now, now),
+            )
+            self._index_terms(conn, learner, keyword)
+            # つながりは両方向に数える
+            conn.executemany(
+                "INSERT INTO links (learner, keyword, related) VALUES (?, ?, ?) "
+                "ON CONFLICT(learner, keyword, related) DO UPDATE SET count = count + 1",
+                [(learner, a, b) for r in related for a, b in ((keyword, r), (r, keyword))],
+            )
+        if time.time() - self._purged_at >= PURGE_INTERVAL: self.purge_anonymous()
+
+    def merge(self, learner, keywords, seen_at=None):
+        # 以前の会話の知識ノートを取り込む（すでにあるキーワードの回数は増やさない）
+        now = seen_at or time.time()
+        keywords = [keyword for keyword in keywords if keyword]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO keywords (learner, keyword, first_seen, last_seen) VALUES (?, ?, ?, ?)",
+                [(learner, keyword, now, now) for keyword in keywords],
+            )
+            for keyword in keywords:
+                self._index_terms(conn, learner, keyword)
+
+    def purge_anonymous(self, now=None):
+        # 最後にキーワードを記録してから anonymous_ttl が過ぎた、名前のない学習者のノートを消す
+        now = now or time.time()
+        self._purged_at = time.time()
+        with self._connect() as conn:
+            expired = [(row[0],) for row in conn.execute(
+                "SELECT learner FROM keywords WHERE learner >= ? AND learner < ? GROUP BY learner HAVING MAX(last_seen) <= ?",
+                (ANONYMOUS_PREFIX, ANONYMOUS_PREFIX + "\U0010ffff", now - self.anonymous_ttl),
+            )]
+            for table in ("keywords", "links", "keyword_terms"):
+                conn.executemany(f"DELETE FROM {table} WHERE learner = ?", expired)
+        return len(expired)
+
+    # --- 参照 ---
+    def count(self, learner):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM keywords WHERE learner = ?", (learner,)).fetchone()[0]
+
+    def recent(self, learner, limit=20):
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM keywords WHERE learner = ? ORDER BY last_seen DESC LIMIT ?",
+                (learner, limit),
+            ).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def _sharing_terms(self, conn, learner, text):
+        # 語を共有するキーワードと、共有する語の数
+        terms = keyword_terms(text)
+        if not terms: return {}
+        placeholders = ", ".join("?" * len(terms))
+        return dict(conn.execute(
+            f"SELECT keyword, COUNT(*) FROM keyword_terms WHERE learner = ? AND term IN ({placeholders}) GROUP BY keyword",
+            (learner, *terms),
+        ))
+
+    def _rows(self, conn, learner, keywords, columns=COLUMNS):
+        rows = {}
+        keywords = list(keywords)
+        # SQLite の変数の上限を超えないように分けて引く
+        for i in range(0, len(keywords), 500):
+            batch = keywords[i:i + 500]
+            placeholders = ", ".join("?" * len(batch))
+            for row in conn.execute(
+                f"SELECT {', '.join(columns)} FROM keywords WHERE learner = ? AND keyword IN ({placeholders})", (learner, *batch)
+            ):
+                rows[row[0]] = row
+        return rows
+
+    def search(self, learner, query, limit=20):
+        # 前方一致は主キーの範囲検索で引き、足りない分を語を共有するキーワードの中から difflib の近い候補で補う
+        query = query.strip()
+        if not query: return self.recent(learner, limit)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM keywords WHERE learner = ? AND keyword >= ? AND keyword < ? "
+                "ORDER BY keyword LIMIT ?",
+                (learner, query, query + "\U0010ffff", limit),
+            ).fetchall()
+            results = [dict(zip(COLUMNS, row)) for row in rows]
+            if len(results) < limit:
+                found = {r["keyword"] for r in results}
+                candidates = self._rows(conn, learner, set(self._sharing_terms(conn, learner, query)) - found)
+                for keyword in difflib.get_close_matches(query, list(candidates), n=limit - len(results), cutoff=0.5):
+                    results.append(dict(zip(COLUMNS, candidates[keyword])))
+        return results
+
+    @staticmethod
+    def _score(keyword, question, shares_terms, document_terms):
+        score = 0.0
+        keyword, question = normalize(keyword), normalize(question)
+        if keyword in question:
+            score += 3.0
+        elif shares_terms:
+            match = difflib.SequenceMatcher(None, keyword, question).find_longest_match(0, len(keyword), 0, len(question))
+            if match.size >= 2 and match.size / len(keyword) >= 0.5: score += 2.0 * match.size / len(keyword)
+        if document_terms is not None:
+            terms = tokenize(keyword)
+            if terms: score += sum(1 for t in terms if t in document_terms) / len(terms)
+        return score
+
+    def relevant(self, learner, question, document_terms=None, top_k=DEFAULT_KEYWORD_TOP_K):
+        # 質問に含まれる（または似ている）キーワードを中心に、資料に出てくるもの、
+        # それらとつながりの強いものの順に、上位 top_k 件だけを返す。
+        # 全件は調べず、質問と語を共有するものと、最近使ったものだけを候補にする
+        with self._connect() as conn:
+            sharing = self._sharing_terms(conn, learner, question)
+            question = normalize(question)
+            recent = conn.execute(
+                "SELECT keyword FROM keywords WHERE learner = ? ORDER BY last_seen DESC LIMIT ?", (learner, RECENT_CANDIDATES)
+            ).fetchall()
+            rows = self._rows(conn, learner, set(sharing) | {row[0] for row in recent}, columns=("keyword", "last_seen", "count"))
+            if not rows: return []
+            scores = {keyword: self._score(keyword, question, keyword in sharing, document_terms) for keyword in rows}
+            matched = [keyword for keyword, score in scores.items() if score >= 2.0]
+            if matched:
+                placeholders = ", ".join("?" * len(matched))
+                boosts = dict(conn.execute(
+                    f"SELECT related, SUM(count) FROM links WHERE learner = ? AND keyword IN ({placeholders}) GROUP BY related",
+                    (learner, *matched),
+                ))
+                # つながりのあるキーワードは、最近使っていなくても候補に加える
+                linked = self._rows(conn, learner, set(boosts) - set(rows), columns=("keyword", "last_seen", "count"))
+                rows.update(linked)
+                for keyword in linked:
+                    scores[keyword] = self._score(keyword, question, False, document_terms)
+                for related, weight in boosts.items():
+                    if related in scores: scores[related] += min(1.0, 0.5 * weight)
+        recency = {keyword: (last_seen, count) for keyword, last_seen, count in rows.values()}
+        ranked = sorted((k for k, s in scores.items() if s > 0), key=lambda k: (scores[k], recency[k]), reverse=True)
+        return ranked[:top_k]
@@ -0,0 +1,214 @@
+# -----------------------------------------------------------------
+# LLMの呼び出し口
+# app.py は genai.GenerativeModel / start_chat / send_message / generate_content の形でしか
+# モデルを使わないため、同じ形を持つものなら差し替えられる。
+#   AI_TUTOR_LLM_BACKEND=gemini（既定）: Google Gemini API
+#   AI_TUTOR_LLM_BACKEND=fake          : APIを使わないローカルの代役（負荷試験・ベンチマーク用）
+# -----------------------------------------------------------------
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from response_parser import KEYWORD_SECTION_WORDS, QUESTION_SECTION_WORDS
+from retrieval import estimate_tokens
+
+MODEL_NAME = 'gemini-1.5-flash'
+
+
+class GeminiBackend:
+    name = "gemini"
+
+    def __init__(self, api_key):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self._genai = genai
+
+    def model(self, system_instruction=None):
+        return self._genai.GenerativeModel(MODEL_NAME, system_instruction=system_instruction)
+
+
+# -----------------------------------------------------------------
+# ローカルの代役（Gemini と同じ形の応答を、設定した速さで少しずつ返す）
+# -----------------------------------------------------------------
+FAKE_KEYWORDS = ["光合成", "葉緑体", "呼吸", "二酸化炭素", "酸素", "デンプン", "気孔", "クロロフィル", "細胞", "エネルギー"]
+
+FAKE_MAIN_SECTION = """「{topic}」について説明します。植物は光のエネルギーを使って、二酸化炭素と水から糖を作ります。
+
+```mermaid
+graph LR
+    A[光] --> B[葉緑体]
+    C[二酸化炭素] --> B
+    D[水] --> B
+    B --> E[糖]
+    B --> F[酸素]
+```
+
+全体の反応は次の式で表せます。
+$$6CO_2 + 6H_2O \\rightarrow C_6H_{{12}}O_6 + 6O_2$$
+
+```json
+{{
+  "data": {{"values": [{{"光の強さ": 1, "速さ": 2}}, {{"光の強さ": 2, "速さ": 4}}, {{"光の強さ": 3, "速さ": 5}},]}},
+  "mark": "line",
+  "encoding": {{"x": {{"field": "光の強さ", "type": "quantitative"}}, "y": {{"field": "速さ", "type": "quantitative"}}}}
+}}
+```
+"""
+
+
+def fake_tutor_response(headings, question):
+    # システムプロンプトの「###」見出しに沿って、PROMPT_TEMPLATES の形式どおりの回答を作る
+    seed = int(hashlib.sha256(question.encode("utf-8")).hexdigest(), 16)
+    topic = question.replace("について、もっと詳しく教えてください。", "")[:30]
+    keywords = [FAKE_KEYWORDS[(seed + i * 3) % len(FAKE_KEYWORDS)] for i in range(3)]
+    parts = ["---"]
+    for i, heading in enumerate(headings):
+        parts.append(f"### {heading}")
+        if any(word in heading for word in QUESTION_SECTION_WORDS):
+            parts.append("\n".join(f"{n}. {keyword}がなくなったら、{topic}はどうなると思う？" for n, keyword in enumerate(keywords, 1)))
+        elif any(word in heading for word in KEYWORD_SECTION_WORDS):
+            parts.append("\n".join(f"- {keyword}" for keyword in keywords))
+        elif "参考" in heading:
+            parts.append(f"- [{topic}の解説](https://example.com/{seed % 1000}) 図が多くて分かりやすい解説です。")
+        elif i == 0:
+            parts.append(FAKE_MAIN_SECTION.format(topic=topic))
+        else:
+            parts.append(f"{topic}について、もう少し考えてみましょう。")
+        parts.append("")
+    parts.append("---")
+    return "\n".join(parts)
+
+
+def fake_plain_response(prompt):
+    # タイトルの提案や要約など、回答形式の決まっていない呼び出し
+    if "タイトル" in prompt:
+        questions = re.findall(r'^- (.+)$', prompt, flags=re.MULTILINE)
+        return (questions[0] if questions else "会話").replace("について、もっと詳しく教えてください。", "")[:10]
+    return "生徒はこれまでに、" + "、".join(re.findall(r'生徒：(.{1,20})', prompt)[:5]) + "について質問した。"
+
+
+def content_text(content):
+    if isinstance(content, str): return content
+    if isinstance(content, dict): return "".join(str(part) for part in content.get("parts", []))
+    return "".join(content_text(item) for item in content)
+
+
+def last_user_text(contents):
+    if isinstance(contents, str): return contents
+    users = [c for c in contents if isinstance(c, dict) and c.get("role") == "user"]
+    return content_text(users[-1]) if users else content_text(contents)
+
+
+class FakeResponse:
+    def __init__(self, backend, text, prompt_tokens, stream):
+        self._backend = backend
+        self._full_text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=estimate_tokens(text),
+            total_token_count=prompt_tokens + estimate_tokens(text),
+        )
+        if not stream:
+            backend._sleep_for(text)
+
+    def __iter__(self):
+        step = self._backend.chunk_chars
+        for i, start in enumerate(range(0, len(self._full_text), step)):
+            chunk = self._full_text[start:start + step]
+            time.sleep(self._backend._first_token_delay() if i == 0 else self._backend._chunk_delay(chunk))
+            yield SimpleNamespace(text=chunk)
+
+    @property
+    def text(self):
+        return self._full_text
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, **kwargs):
+        contents = self.history + [{"role": "user", "parts": [content_text(content)]}]
+        response = self.model.generate_content(contents, stream=stream)
+        # Gemini と同じく、回答が揃ってから履歴に追加する
+        self.history = contents + [{"role": "model", "parts": [response.text]}]
+        return response
+
+
+class FakeModel:
+    def __init__(self, backend, system_instruction=None):
+        self.backend = backend
+        self.system_instruction = system_instruction or ""
+        self.headings = re.findall(r'^### (.+)$', self.system_instruction, flags=re.MULTILINE)
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history)
+
+    def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+        self.backend.count_call()
+        question = last_user_text(contents)
+        # 抜粋つきの質問は、質問の部分だけを使う
+        question = question.rsplit("質問：", 1)[-1].strip()
+        text = fake_tutor_response(self.headings, question) if self.headings else fake_plain_response(question)
+        prompt_tokens = estimate_tokens(self.system_instruction) + estimate_tokens(content_text(contents))
+        return FakeResponse(self.backend, text, prompt_tokens, stream)
+
+
+class FakeBackend:
+    name = "fake"
+
+    def __init__(self, first_token_latency=0.5, tokens_per_second=150, chunk_chars=40, jitter=0.2, seed=None):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.chunk_chars = chunk_chars
+        self.jitter = jitter
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            first_token_latency=float(os.environ.get("AI_TUTOR_FAKE_FIRST_TOKEN", 0.5)),
+            tokens_per_second=float(os.environ.get("AI_TUTOR_FAKE_TOKENS_PER_SECOND", 150)),
+            chunk_chars=int(os.environ.get("AI_TUTOR_FAKE_CHUNK_CHARS", 40)),
+        )
+
+    def count_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def _jittered(self, seconds):
+        with self._lock:
+            return max(0.0, seconds * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def _first_token_delay(self):
+        return self._jittered(self.first_token_latency)
+
+    def _chunk_delay(self, chunk):
+        return self._jittered(estimate_tokens(chunk) / self.tokens_per_second) if self.tokens_per_second else 0.0
+
+    def _sleep_for(self, text):
+        time.sleep(self._first_token_delay() + (self._jittered(estimate_tokens(text) / self.tokens_per_second) if self.tokens_per_second else 0.0))
+
+    def model(self, system_instruction=None):
+        return FakeModel(self, system_instruction)
+
+
+def selected_backend_name():
+    return os.environ.get("AI_TUTOR_LLM_BACKEND", "gemini")
+
+
+def create_backend(api_key=None, name=None):
+    name = name or selected_backend_name()
+    if name == "fake":
+        return FakeBackend.from_env()
+    if name == "gemini":
+        if not api_key: raise KeyError("GEMINI_API_KEY")
+        return GeminiBackend(api_key)
+    raise ValueError(f"unknown LLM backend: {name}")
@@ -0,0 +1,442 @@
+# -----------------------------------------------------------------
+# LLM呼び出しの関所（プロセス全体で1つ）
+# 全セッションのAI呼び出しをここに通し、APIの上限（1分あたりのリクエスト数・トークン数）を超えないように
+# 順番待ちをさせる。待ち行列はセッションごとに分け、対話の質問を先読みやタイトルの提案より優先する。
+# 上限超過などの一時的なエラーは、間隔を空けて再試行する。
+# まったく同じ内容の呼び出しが同時に来たときは、1回だけ呼び出して結果を共有する。
+# 逐次表示の応答は関所のスレッドが最後まで受け取り、読み手がいなくなっても（途中で画面が
+# 再実行されても）受け取り終えた時点か STREAM_TIMEOUT の時点で必ず同時実行の枠を返す。
+# 断片の間で止まった応答も、見張りのタイマーが時間切れにして枠を返す。
+#   AI_TUTOR_LLM_RPM=2000          : 1分あたりのリクエスト数の上限
+#   AI_TUTOR_LLM_TPM=4000000       : 1分あたりのトークン数の上限（送信分＋回答の見込み）
+#   AI_TUTOR_LLM_CONCURRENCY=16    : 同時に実行する呼び出しの数
+# -----------------------------------------------------------------
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+import metrics
+from llm_backend import content_text
+from retrieval import estimate_tokens
+
+INTERACTIVE, BACKGROUND = 0, 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+DEFAULT_RPM = 2000
+DEFAULT_TPM = 4_000_000
+DEFAULT_CONCURRENCY = 16
+DEFAULT_ATTEMPTS = 4
+# 回答の長さは呼び出す前には分からないため、この分を見込んでおく
+EXPECTED_OUTPUT_TOKENS = 1000
+QUEUE_TIMEOUT = 120
+# 逐次表示の応答を受け取り続ける上限の秒数
+STREAM_TIMEOUT = 300
+
+# google.api_core.exceptions をインポートせずに、名前で一時的なエラーを見分ける
+RETRYABLE_ERRORS = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError"}
+
+
+class LLMBusy(Exception):
+    # 混雑（順番待ちの時間切れ、再試行しても続いた上限超過）で答えられなかった
+    pass
+
+
+class QueueTimeout(LLMBusy):
+    pass
+
+
+class StreamTimeout(Exception):
+    pass
+
+
+def is_retryable(error):
+    return type(error).__name__ in RETRYABLE_ERRORS or getattr(error, "code", None) in (429, 503)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount, now):
+        # 足りるまでの秒数（0なら今すぐ取れる）。上限より大きい呼び出しも、満杯になれば通す
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class Ticket:
+    __slots__ = ("session", "priority", "tokens", "enqueued_at")
+
+    def __init__(self, session, priority, tokens):
+        self.session = session
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+
+class SharedResponse:
+    # 逐次表示の応答を複数の呼び出し元で共有する。関所のスレッドが元の応答から受け取って保持し、
+    # 読み手はそれを順に読む（後から来た読み手も最初から読める）
+    def __init__(self, wait_timeout=None):
+        # wait_timeout: 次の断片（または終了）をこの秒数待っても来なければ、読み手は諦める
+        self.wait_timeout = wait_timeout
+        self._response = None
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._callbacks = []
+        self._condition = threading.Condition()
+
+    # --- 関所のスレッドから呼ぶ ---
+    def _attach(self, response):
+        self._response = response
+
+    def _append(self, chunk):
+        with self._condition:
+            if self._done: return
+            self._chunks.append(chunk)
+            self._condition.notify_all()
+
+    def _started(self):
+        with self._condition:
+            return bool(self._chunks)
+
+    def _finish(self, error=None):
+        # 時間切れと受け取りの終了のどちらが先でも、最初の1回だけを使う
+        with self._condition:
+            if self._done: return
+            self._done = True
+            self._error = error
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+        if error is None:
+            for callback in callbacks: callback(self)
+
+    def add_done_callback(self, callback):
+        # 最後まで受け取れたときに呼ぶ（すでに終わっていればすぐに呼ぶ）
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+            failed = self._error is not None
+        if not failed: callback(self)
+
+    # --- 読み手 ---
+    def __iter__(self):
+        for i in itertools.count():
+            with self._condition:
+                while len(self._chunks) <= i and not self._done:
+                    if not self._condition.wait(self.wait_timeout):
+                        raise StreamTimeout("AIの回答が途中で止まりました")
+                if i < len(self._chunks):
+                    chunk = self._chunks[i]
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
+            yield chunk
+
+    @property
+    def text(self):
+        texts = []
+        for chunk in self:
+            try:
+                texts.append(chunk.text)
+            except ValueError:
+                continue
+        return "".join(texts)
+
+    @property
+    def usage_metadata(self):
+        return getattr(self._response, "usage_metadata", None)
+
+
+class InFlight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LLMGateway:
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, max_concurrency=DEFAULT_CONCURRENCY,
+                 attempts=DEFAULT_ATTEMPTS, queue_timeout=QUEUE_TIMEOUT, stream_timeout=STREAM_TIMEOUT):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.attempts = attempts
+        self.queue_timeout = queue_timeout
+        self.stream_timeout = stream_timeout
+        self._condition = threading.Condition()
+        # 優先度ごとに、セッション → そのセッションの待ち行列。先頭のセッションから順に1件ずつ通す
+        self._queues = {INTERACTIVE: OrderedDict(), BACKGROUND: OrderedDict()}
+        self._running = 0
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._stats = {"calls": 0, "coalesced": 0, "retries": 0, "rate_limited": 0, "timeouts": 0, "wait_seconds": 0.0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rpm=int(os.environ.get("AI_TUTOR_LLM_RPM", DEFAULT_RPM)),
+            tpm=int(os.environ.get("AI_TUTOR_LLM_TPM", DEFAULT_TPM)),
+            max_concurrency=int(os.environ.get("AI_TUTOR_LLM_CONCURRENCY", DEFAULT_CONCURRENCY)),
+        )
+
+    # --- 順番待ち ---
+    def _head(self):
+        for priority in (INTERACTIVE, BACKGROUND):
+            for queue in self._queues[priority].values():
+                return queue[0]
+        return None
+
+    def _dequeue(self, ticket):
+        sessions = self._queues[ticket.priority]
+        queue = sessions[ticket.session]
+        queue.popleft()
+        # 通したセッションは最後尾に回し、1つのセッションが連続して使い続けないようにする
+        del sessions[ticket.session]
+        if queue: sessions[ticket.session] = queue
+
+    def _acquire(self, session, priority, tokens):
+        ticket = Ticket(session, priority, tokens)
+        deadline = ticket.enqueued_at + self.queue_timeout
+        with self._condition:
+            self._queues[priority].setdefault(session, deque()).append(ticket)
+            limited = False
+            while True:
+                now = time.monotonic()
+                if self._head() is ticket and self._running < self.max_concurrency:
+                    wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                    if wait == 0:
+                        self._dequeue(ticket)
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        self._running += 1
+                        break
+                    limited = True
+                else:
+                    wait = None
+                if now >= deadline:
+                    self._queues[priority][session].remove(ticket)
+                    if not self._queues[priority][session]: del self._queues[priority][session]
+                    self._stats["timeouts"] += 1
+                    self._condition.notify_all()
+                    raise QueueTimeout("AIへの問い合わせが混み合っています")
+                self._condition.wait(min(wait, deadline - now) if wait is not None else deadline - now)
+            waited = time.monotonic() - ticket.enqueued_at
+            self._stats["calls"] += 1
+            self._stats["wait_seconds"] += waited
+            if limited: self._stats["rate_limited"] += 1
+            self._condition.notify_all()
+        metrics.observe("llm_queue_wait_seconds", waited, priority=PRIORITY_NAMES[priority])
+
+    def _release(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def _retrying(self, retry=is_retryable):
+        def count_retry(retry_state):
+            with self._condition:
+                self._stats["retries"] += 1
+
+        return Retrying(
+            stop=stop_after_attempt(self.attempts),
+            wait=wait_exponential_jitter(initial=1, max=20),
+            retry=retry_if_exception(retry),
+            before_sleep=count_retry,
+            reraise=True,
+        )
+
+    def _call(self, session, priority, tokens, fn):
+        # 再試行のたびに順番待ちからやり直す（待っている他のセッションを追い越さない）
+        def attempt():
+            self._acquire(session, priority, tokens)
+            try:
+                return fn()
+            finally:
+                self._release()
+
+        try:
+            return self._retrying()(attempt)
+        except Exception as e:
+            if is_retryable(e): raise LLMBusy("AIへの問い合わせが混み合っています") from e
+            raise
+
+    def _stream(self, session, priority, tokens, fn, on_done):
+        # 逐次表示の応答は関所のスレッドで最後まで受け取り、受け取り終えたら（読み手の有無に関係なく）枠を返す。
+        # 最初の断片が届く前のエラーは再試行し、届いた後のエラーは読み手に伝える
+        # 読み手は、順番待ちと受け取りの上限を合わせた時間まで次の断片を待つ
+        shared = SharedResponse(wait_timeout=self.queue_timeout + self.stream_timeout)
+
+        def attempt():
+            self._acquire(session, priority, tokens)
+            released = threading.Event()
+            release_lock = threading.Lock()
+
+            def release():
+                with release_lock:
+                    if released.is_set(): return False
+                    released.set()
+                self._release()
+                return True
+
+            def expire():
+                # 元の応答が断片の間で止まっていても、枠を返して読み手に時間切れを伝える
+                if not release(): return
+                with self._condition:
+                    self._stats["timeouts"] += 1
+                shared._finish(StreamTimeout(f"AIの回答が{self.stream_timeout}秒以内に終わりませんでした"))
+                on_done()
+
+            watchdog = threading.Timer(self.stream_timeout, expire)
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                response = fn()
+                shared._attach(response)
+                for chunk in response:
+                    if released.is_set(): break
+                    shared._append(chunk)
+            finally:
+                watchdog.cancel()
+                release()
+
+        def pump():
+            try:
+                self._retrying(lambda e: is_retryable(e) and not shared._started())(attempt)
+            except Exception as e:
+                shared._finish(LLMBusy("AIへの問い合わせが混み合っています") if is_retryable(e) else e)
+            else:
+                shared._finish()
+            finally:
+                on_done()
+
+        threading.Thread(target=pump, daemon=True, name="llm-stream").start()
+        return shared
+
+    # --- 同じ呼び出しの共有 ---
+    def call(self, key, session, priority, tokens, fn, stream=False):
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = InFlight()
+        if not leader:
+            with self._condition:
+                self._stats["coalesced"] += 1
+            metrics.inc("llm_coalesced")
+            flight.event.wait()
+            if flight.error is not None: raise flight.error
+            return flight.result
+        if stream:
+            # 逐次表示の応答は、受け取り終えるまで後から来た同じ呼び出しにも共有する
+            flight.result = self._stream(session, priority, tokens, fn, on_done=lambda: self._forget(key, flight))
+            flight.event.set()
+            return flight.result
+        try:
+            flight.result = self._call(session, priority, tokens, fn)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._forget(key, flight)
+            flight.event.set()
+        return flight.result
+
+    def _forget(self, key, flight):
+        with self._flights_lock:
+            if self._flights.get(key) is flight: del self._flights[key]
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            queued = {PRIORITY_NAMES[p]: sum(len(q) for q in sessions.values()) for p, sessions in self._queues.items()}
+            stats.update(
+                queued_interactive=queued["interactive"], queued_background=queued["background"],
+                running=self._running, sessions_waiting=sum(len(sessions) for sessions in self._queues.values()),
+                mean_wait_seconds=stats["wait_seconds"] / stats["calls"] if stats["calls"] else 0.0,
+            )
+        return stats
+
+
+# -----------------------------------------------------------------
+# 既存の LLMバックエンドを包んで、すべての呼び出しを関所に通す
+# -----------------------------------------------------------------
+def request_key(system_instruction, contents, stream):
+    payload = json.dumps([system_instruction or "", contents, stream], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GatewayChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def _add_turn(self, contents, text):
+        self.history = contents + [{"role": "model", "parts": [text]}]
+
+    def send_message(self, content, stream=False, **kwargs):
+        contents = self.history + [{"role": "user", "parts": [content_text(content)]}]
+        response = self.model.generate_content(contents, stream=stream, **kwargs)
+        if stream:
+            # 逐次表示の応答は、受け取り終えたときに履歴に加える（チャットは応答を持ち続けない）
+            response.add_done_callback(lambda done: self._add_turn(contents, done.text))
+        else:
+            self._add_turn(contents, response.text)
+        return response
+
+
+class GatewayModel:
+    def __init__(self, gateway, model, system_instruction, session, priority):
+        self.gateway = gateway
+        self.model = model
+        self.system_instruction = system_instruction
+        self.session = session
+        self.priority = priority
+
+    def with_priority(self, priority):
+        return GatewayModel(self.gateway, self.model, self.system_instruction, self.session, priority)
+
+    def start_chat(self, history=None):
+        return GatewayChat(self, history)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        tokens = estimate_tokens(self.system_instruction or "") + estimate_tokens(content_text(contents)) + EXPECTED_OUTPUT_TOKENS
+        if stream and "request_options" not in kwargs:
+            # APIの側でも、止まった応答を時間切れにする
+            kwargs["request_options"] = {"timeout": self.gateway.stream_timeout}
+        key = request_key(self.system_instruction, contents, stream)
+        return self.gateway.call(
+            key, self.session, self.priority, tokens,
+            lambda: self.model.generate_content(contents, stream=stream, **kwargs), stream=stream,
+        )
+
+
+class GatewayBackend:
+    def __init__(self, backend, gateway):
+        self.backend = backend
+        self.gateway = gateway
+        self.name = backend.name
+
+    def model(self, system_instruction=None, session=None, priority=INTERACTIVE):
+        return GatewayModel(self.gateway, self.backend.model(system_instruction=system_instruction), system_instruction, session, priority)
@@ -0,0 +1,154 @@
+# -----------------------------------------------------------------
+# 会話の記憶（トークン予算つき）
+# 直近のやりとりはそのまま残し、それより古いやりとりは要約にまとめてから
+# Gemini のチャット履歴を組み立てる。保存済みの会話を読み込んだときも同じ方法で作り直す。
+# 要約のAI呼び出しは質問への回答を待たせないよう、数回分のやりとりをまとめてバックグラウンドで行う。
+# -----------------------------------------------------------------
+from jobs import RUNNING
+from retrieval import estimate_tokens
+
+DEFAULT_KEEP_TURNS = 4
+DEFAULT_HISTORY_BUDGET = 6000
+SUMMARY_MAX_CHARS = 600
+# 要約からあふれたやりとりがこの件数たまったら、まとめてAIに要約してもらう
+DEFAULT_FOLD_BATCH = 4
+SUMMARY_TIMEOUT = 60
+
+SUMMARY_PROMPT = """以下は、家庭教師と生徒の会話の記録です。
+「これまでの要約」と「新しいやりとり」をまとめて、生徒が何を質問し、何を理解したかが分かる要約を日本語で{max_chars}文字以内で作成してください。
+要約の本文のみを返答してください。
+
+【これまでの要約】
+{summary}
+
+【新しいやりとり】
+{turns}
+"""
+
+SUMMARY_USER_PREFIX = "【これまでの会話の要約】\n"
+SUMMARY_MODEL_REPLY = "わかりました。これまでの内容を踏まえて続けます。"
+
+
+def split_turns(messages):
+    # ユーザーの質問とAIの回答の組にまとめる（回答のない質問は含めない）
+    turns = []
+    for i in range(len(messages) - 1):
+        if messages[i]["role"] == "user" and messages[i + 1]["role"] == "model":
+            turns.append((messages[i], messages[i + 1]))
+    return turns
+
+
+def turn_tokens(turn):
+    return estimate_tokens(turn[0]["content"]) + estimate_tokens(turn[1]["content"])
+
+
+def format_turns(turns):
+    return "\n\n".join(f"生徒：{question['content']}\n先生：{answer['content']}" for question, answer in turns)
+
+
+def extractive_summary(summary, turns, max_chars=SUMMARY_MAX_CHARS):
+    # 要約用のAI呼び出しに失敗したときの代わり：質問と回答の冒頭だけを並べる
+    lines = [summary] if summary else []
+    for question, answer in turns:
+        first_line = next((line.strip() for line in answer["content"].splitlines() if line.strip() and not line.startswith(("#", "-", "`"))), "")
+        lines.append(f"- 質問：{question['content']} / 回答の要点：{first_line[:80]}")
+    text = "\n".join(lines)
+    # 長くなりすぎたら、新しい方を残す
+    return text[-max_chars:]
+
+
+class ConversationMemory:
+    def __init__(self, keep_turns=DEFAULT_KEEP_TURNS, token_budget=DEFAULT_HISTORY_BUDGET, summarize=None, executor=None, fold_batch=DEFAULT_FOLD_BATCH):
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        # summarize はバックグラウンドのスレッドから呼ばれることがある（executor を渡したとき）
+        self.summarize = summarize
+        self.executor = executor
+        self.fold_batch = fold_batch
+        self.summary = ""
+        self.summarized_turns = 0
+        self.last_stats = {}
+        # 実行中の要約（ジョブID、要約し終えるやりとりの数、元にした要約）
+        self._fold_job = None
+
+    # 別のプロセスで会話を再開するとき、要約を作り直さずに済むよう要約だけを保存する
+    def snapshot(self):
+        return {"summary": self.summary, "summarized_turns": self.summarized_turns}
+
+    def restore(self, snapshot):
+        self.summary = snapshot.get("summary", "")
+        self.summarized_turns = snapshot.get("summarized_turns", 0)
+
+    def _verbatim_start(self, turns):
+        # 直近 keep_turns 件のうち、要約と合わせて予算に収まる分だけをそのまま残す（最低1件）
+        budget = self.token_budget - estimate_tokens(self.summary)
+        used, start = 0, len(turns)
+        while start > 0 and len(turns) - start < self.keep_turns:
+            tokens = turn_tokens(turns[start - 1])
+            if used + tokens > budget and start < len(turns): break
+            used += tokens
+            start -= 1
+        return start
+
+    def _summarize(self, summary, turns):
+        prompt = SUMMARY_PROMPT.format(max_chars=SUMMARY_MAX_CHARS, summary=summary or "なし", turns=format_turns(turns))
+        try:
+            text = self.summarize(prompt).strip() if self.summarize else ""
+        except Exception:
+            text = ""
+        return text[:SUMMARY_MAX_CHARS * 2] if text else extractive_summary(summary, turns)
+
+    def _collect_fold(self):
+        # バックグラウンドの要約が終わっていれば取り込む（元にした要約が変わっていたら捨てる）
+        if self._fold_job is None: return
+        job_id, upto, base = self._fold_job
+        job = self.executor.poll(job_id)
+        if job["status"] == RUNNING: return
+        self.executor.forget(job_id)
+        self._fold_job = None
+        result = job["result"]
+        if result and base == self.summary and upto > self.summarized_turns:
+            self.summary, self.summarized_turns = result, upto
+
+    def _fold(self, turns, upto):
+        summary = self.summary
+        if self.executor is None:
+            self.summary, self.summarized_turns = self._summarize(summary, turns), upto
+            return
+        fallback = extractive_summary(summary, turns)
+        job_id = self.executor.submit(lambda timeout: self._summarize(summary, turns), timeout=SUMMARY_TIMEOUT, attempts=1, fallback=fallback)
+        self._fold_job = (job_id, upto, summary)
+
+    def history(self, messages):
+        turns = split_turns(messages)
+        # 会話がリセットされていたら、要約も捨てる
+        if len(turns) < self.summarized_turns:
+            self.summary, self.summarized_turns = "", 0
+            if self._fold_job: self.executor.forget(self._fold_job[0])
+            self._fold_job = None
+        self._collect_fold()
+        fold_upto = self._verbatim_start(turns)
+        pending = turns[self.summarized_turns:fold_upto]
+        # あふれたやりとりは数件たまってからまとめて要約する。それまでの間（と要約の実行中）は、
+        # AIを呼ばずに作れる抜き書きの要約で代わりにする
+        if len(pending) >= self.fold_batch and self._fold_job is None:
+            self._fold(pending, fold_upto)
+            pending = turns[self.summarized_turns:fold_upto]
+        summary = extractive_summary(self.summary, pending) if pending else self.summary
+        verbatim = turns[max(self.summarized_turns, fold_upto):]
+
+        history = []
+        if summary:
+            history.append({"role": "user", "parts": [SUMMARY_USER_PREFIX + summary]})
+            history.append({"role": "model", "parts": [SUMMARY_MODEL_REPLY]})
+        for question, answer in verbatim:
+            history.append({"role": "user", "parts": [question["content"]]})
+            history.append({"role": "model", "parts": [answer["content"]]})
+        self.last_stats = {
+            "summary_tokens": estimate_tokens(summary),
+            "summarized_turns": self.summarized_turns,
+            "pending_turns": len(pending),
+            "verbatim_turns": len(verbatim),
+            "history_tokens": sum(estimate_tokens(entry["parts"][0]) for entry in history),
+        }
+        return history
@@ -0,0 +1,296 @@
+# -----------------------------------------------------------------
+# 処理時間の計測と集計
+# rerun の各段階（取得・抽出・プロンプト作成・モデル作成・LLM呼び出し・表示・履歴一覧）を
+# span で囲み、全セッション分を集計して Prometheus 形式か JSON で出力する。
+# 集計はプロセスごと（同じプロセスのセッションの分だけ）。複数のプロセスで動かすときは、
+# プロセスごとのポートをそれぞれ集めて Prometheus 側で合計する。
+#   AI_TUTOR_METRICS=1               : 計測を有効にする（無効のときは何もしない span を返すだけ）
+#   AI_TUTOR_METRICS_PORT=9464       : /metrics（Prometheus）と /metrics.json を返すHTTPサーバーを起動する（計測も有効になる）
+#                                      9464-9471 のように範囲で指定すると、プロセスごとに空いているポートを使う
+#   AI_TUTOR_METRICS_HOST=127.0.0.1  : HTTPサーバーの待ち受けアドレス（外から集める場合だけ 0.0.0.0 などにする）
+#   AI_TUTOR_PROFILE_DIR=profiles    : 遅かった rerun の cProfile の結果を保存する
+# -----------------------------------------------------------------
+import bisect
+import cProfile
+import errno
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+# 秒単位のヒストグラムの区切り
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (100, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+PROFILE_KEEP = 5
+
+# Prometheus の # HELP に出す説明（ないものは名前から作る）
+HELP = {
+    "stage_seconds": "Time spent in each stage of a rerun",
+    "stage_errors": "Stages that ended with an exception",
+    "llm_first_token_seconds": "Time until the first chunk of an answer",
+    "llm_queue_wait_seconds": "Time an LLM call waited in the gateway queue",
+    "prompt_tokens": "Tokens sent per question",
+    "response_chars": "Characters per answer",
+    "page_cache": "Page cache lookups by result",
+    "answer_cache": "Answer cache lookups by result",
+    "prefetch": "Prefetched answers used or missed",
+    "llm_coalesced": "LLM calls answered by an identical call already in flight",
+    "session_state_errors": "Failures saving or restoring session state",
+    "collector_errors": "Errors raised while collecting gauges",
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_collector(self, name, collect):
+        # 各キャッシュの stats() のように、出力のたびに値を集める関数を登録する
+        with self._lock:
+            self.collectors[name] = collect
+
+    def collect(self):
+        gauges = {}
+        with self._lock:
+            collectors = list(self.collectors.items())
+        for name, collect in collectors:
+            try:
+                gauges[name] = {key: value for key, value in collect().items() if isinstance(value, (int, float))}
+            except Exception:
+                self.inc("collector_errors", collector=name)
+        return gauges
+
+    def snapshot(self):
+        gauges = self.collect()
+        with self._lock:
+            return {
+                "time": time.time(),
+                "gauges": gauges,
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), "count": h.count, "sum": h.total,
+                     "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts))}
+                    for (name, labels), h in self.histograms.items()
+                ],
+            }
+
+    def prometheus(self):
+        lines = []
+        for name, values in sorted(self.collect().items()):
+            for key, value in sorted(values.items()):
+                lines.extend(describe(f"ai_tutor_{name}_{key}", "gauge", f"{name} {key}"))
+                lines.append(f"ai_tutor_{name}_{key} {value}")
+        with self._lock:
+            described = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if (name, "counter") not in described:
+                    described.add((name, "counter"))
+                    lines.extend(describe(f"ai_tutor_{name}_total", "counter", HELP.get(name, name)))
+                lines.append(f"ai_tutor_{name}_total{format_labels(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                if (name, "histogram") not in described:
+                    described.add((name, "histogram"))
+                    lines.extend(describe(f"ai_tutor_{name}", "histogram", HELP.get(name, name)))
+                cumulative = 0
+                for bound, count in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cumulative += count
+                    lines.append(f"ai_tutor_{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"ai_tutor_{name}_sum{format_labels(labels)} {h.total}")
+                lines.append(f"ai_tutor_{name}_count{format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def describe(metric, kind, help_text):
+    help_text = help_text.replace("\\", "\\\\").replace("\n", "\\n")
+    return [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+class Span:
+    __slots__ = ("registry", "stage", "started")
+
+    def __init__(self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe("stage_seconds", time.perf_counter() - self.started, stage=self.stage)
+        if exc_type is not None: self.registry.inc("stage_errors", stage=self.stage)
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+METRICS_PORT = os.environ.get("AI_TUTOR_METRICS_PORT")
+# 内部の統計なので、既定では同じマシンからしか読めないようにする
+METRICS_HOST = os.environ.get("AI_TUTOR_METRICS_HOST", "127.0.0.1")
+# ポートを指定したときは、AI_TUTOR_METRICS がなくても計測する
+ENABLED = bool(METRICS_PORT) or os.environ.get("AI_TUTOR_METRICS", "") not in ("", "0", "false")
+REGISTRY = Registry()
+
+
+def span(stage):
+    # 無効のときは、同じ何もしないオブジェクトを返すだけにして負荷を抑える
+    return Span(REGISTRY, stage) if ENABLED else NOOP_SPAN
+
+
+def inc(name, value=1, **labels):
+    if ENABLED: REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    if ENABLED: REGISTRY.observe(name, seconds, **labels)
+
+
+def observe_size(name, value, **labels):
+    if ENABLED: REGISTRY.observe(name, value, buckets=SIZE_BUCKETS, **labels)
+
+
+class RerunProfiler:
+    # rerun 全体を cProfile で計測し、遅かった上位 keep 件だけをファイルに残す
+    def __init__(self, directory, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._slowest = []
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 別のセッションの rerun をプロファイル中なら、この rerun は計測しない
+            return None
+        return profile
+
+    def finish(self, profile, seconds):
+        profile.disable()
+        with self._lock:
+            if len(self._slowest) >= self.keep and seconds <= self._slowest[0][0]: return
+            path = os.path.join(self.directory, f"rerun-{seconds * 1000:.0f}ms-{int(time.time() * 1000)}.prof")
+            profile.dump_stats(path)
+            self._slowest.append((seconds, path))
+            self._slowest.sort()
+            while len(self._slowest) > self.keep:
+                _, old_path = self._slowest.pop(0)
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+
+
+PROFILE_DIR = os.environ.get("AI_TUTOR_PROFILE_DIR")
+_profiler = RerunProfiler(PROFILE_DIR) if PROFILE_DIR else None
+_current = threading.local()
+
+
+def begin_rerun():
+    # st.rerun() や st.stop() は例外でスクリプトを抜けるため、with ではなく開始と終了を明示的に呼ぶ
+    if not ENABLED and _profiler is None: return
+    # 例外で終わって閉じられなかった前回の rerun は、時間が不正確なので記録せずに捨てる
+    stale = getattr(_current, "rerun", None)
+    if stale and stale[1] is not None: stale[1].disable()
+    _current.rerun = (time.perf_counter(), _profiler.start() if _profiler else None)
+
+
+def end_rerun():
+    rerun = getattr(_current, "rerun", None)
+    if rerun is None: return
+    _current.rerun = None
+    started, profile = rerun
+    seconds = time.perf_counter() - started
+    if ENABLED: REGISTRY.observe("stage_seconds", seconds, stage="rerun")
+    if profile is not None: _profiler.finish(profile, seconds)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body, content_type = json.dumps(REGISTRY.snapshot(), ensure_ascii=False).encode("utf-8"), "application/json"
+        elif self.path.startswith("/metrics"):
+            body, content_type = REGISTRY.prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def parse_ports(spec):
+    # "9464" または "9464-9471"
+    first, _, last = str(spec).partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+def start_server(ports, host=METRICS_HOST):
+    # 同じマシンの別のプロセスがポートを使っていたら、範囲内の次のポートを試す。
+    # 空きがなければ公開せずに続ける（アプリの表示は止めない）
+    for port in parse_ports(ports):
+        try:
+            server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE: raise
+            continue
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        return server
+    print(f"メトリクスのポート {ports} は使用中のため、このプロセスの集計は公開しません。", file=sys.stderr)
+    return None
@@ -0,0 +1,212 @@
+# -----------------------------------------------------------------
+# Webページのディスクキャッシュ
+# 取得したHTMLと抽出したテキストを内容のハッシュで保存し、複数のプロセスから共有する。
+# 索引は SQLite（WALモード）に置き、本体は blobs/ 以下のファイルとして原子的に書き込む。
+# -----------------------------------------------------------------
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+
+import requests
+import trafilatura
+
+import metrics
+import storage
+from storage import CACHE_DIR
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# この時間内に確認済みのページは、サーバーに問い合わせずにそのまま使う
+DEFAULT_FRESH_SECONDS = 600
+FETCH_TIMEOUT = 20
+USER_AGENT = "Mozilla/5.0 (compatible; ai-tutor-app)"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    html_hash TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    checked_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS extractions (
+    html_hash TEXT PRIMARY KEY,
+    text_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access);
+""" + storage.STATS_SCHEMA
+
+
+class FetchError(Exception):
+    pass
+
+
+def extract_text(html):
+    return trafilatura.extract(html, include_comments=False, include_tables=True)
+
+
+class PageCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, fresh_seconds=DEFAULT_FRESH_SECONDS):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        os.makedirs(self.blob_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return storage.connect(os.path.join(self.root, "index.sqlite3"), autocommit=True)
+
+    # --- 本体ファイル（内容のハッシュで名前を付ける） ---
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def _write_blob(self, conn, data):
+        # トランザクションの中で呼ぶ（行を書くまでの間に、別プロセスの削除で本体が消えないように）
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 別プロセスが同じ内容を書いても壊れないよう、一時ファイルから置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        conn.execute(
+            "INSERT INTO blobs (hash, size, last_access) VALUES (?, ?, ?) "
+            "ON CONFLICT(hash) DO UPDATE SET last_access = excluded.last_access",
+            (digest, len(data), time.time()),
+        )
+        return digest
+
+    def _read_blob(self, digest):
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    # --- 統計 ---
+    def stats(self):
+        with self._connect() as conn:
+            counters = storage.counters(conn)
+            pages, = conn.execute("SELECT COUNT(*) FROM pages").fetchone()
+            total_bytes, = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        result = {name: counters.get(name, 0) for name in ("hits", "revalidated", "misses", "bytes_saved", "extractions_saved")}
+        lookups = result["hits"] + result["revalidated"] + result["misses"]
+        result.update(pages=pages, total_bytes=total_bytes, hit_rate=(result["hits"] + result["revalidated"]) / lookups if lookups else 0.0)
+        return result
+
+    # --- 取得 ---
+    def _fetch(self, url, etag=None, last_modified=None, timeout=FETCH_TIMEOUT, fetch_slot=None):
+        headers = {"User-Agent": USER_AGENT}
+        if etag: headers["If-None-Match"] = etag
+        if last_modified: headers["If-Modified-Since"] = last_modified
+        try:
+            # fetch_slot は同じホストへの同時接続数を制限したい呼び出し側が渡す
+            with fetch_slot(url) if fetch_slot else contextlib.nullcontext():
+                with metrics.span("fetch"):
+                    response = requests.get(url, headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            raise FetchError(str(e)) from e
+        if response.status_code == 304:
+            return None, response.headers
+        if response.status_code != 200 or not response.content:
+            raise FetchError(f"HTTP {response.status_code}")
+        return response.content, response.headers
+
+    def _stored_text(self, conn, html_hash):
+        # 同じHTMLなら、URLが違っても抽出結果を使い回す
+        row = conn.execute("SELECT text_hash FROM extractions WHERE html_hash = ?", (html_hash,)).fetchone()
+        data = self._read_blob(row[0]) if row else None
+        if data is None: return None
+        conn.execute("UPDATE blobs SET last_access = ? WHERE hash = ?", (time.time(), row[0]))
+        storage.count(conn, extractions_saved=1)
+        return data.decode("utf-8")
+
+    def _store_text(self, conn, html_hash, text):
+        # トランザクションの中で呼ぶ
+        if text is None: return
+        text_hash = self._write_blob(conn, text.encode("utf-8"))
+        conn.execute("INSERT OR REPLACE INTO extractions (html_hash, text_hash) VALUES (?, ?)", (html_hash, text_hash))
+
+    def get_text(self, url, extract=extract_text, timeout=FETCH_TIMEOUT, fetch_slot=None):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT p.html_hash, p.etag, p.last_modified, p.checked_at, b.size FROM pages p "
+                "JOIN blobs b ON b.hash = p.html_hash WHERE p.url = ?", (url,)
+            ).fetchone()
+            html = None
+            if row:
+                html_hash, etag, last_modified, checked_at, html_size = row
+                fresh = now - checked_at < self.fresh_seconds
+                if not fresh:
+                    # 期限切れなら、条件付きリクエストで変更の有無だけを確認する
+                    html, headers = self._fetch(url, etag, last_modified, timeout, fetch_slot)
+                if fresh or html is None:
+                    text = self._stored_text(conn, html_hash)
+                    cached_html = self._read_blob(html_hash) if text is None else None
+                    if text is not None or cached_html is not None:
+                        if text is None:
+                            with metrics.span("extraction"):
+                                text = extract(cached_html)
+                        with storage.transaction(conn):
+                            self._store_text(conn, html_hash, text)
+                            conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (now, url))
+                            if not fresh: conn.execute("UPDATE pages SET checked_at = ? WHERE url = ?", (now, url))
+                            conn.execute("UPDATE blobs SET last_access = ? WHERE hash = ?", (now, html_hash))
+                            storage.count(conn, **{"hits" if fresh else "revalidated": 1, "bytes_saved": html_size})
+                        metrics.inc("page_cache", result="hit" if fresh else "revalidated")
+                        return text
+                    # 別プロセスの削除と競合して本体が消えていた場合は、未取得として扱う
+            if html is None:
+                html, headers = self._fetch(url, timeout=timeout, fetch_slot=fetch_slot)
+            metrics.inc("page_cache", result="miss")
+
+            html_hash = hashlib.sha256(html).hexdigest()
+            text = self._stored_text(conn, html_hash)
+            extracted = text is None
+            if extracted:
+                with metrics.span("extraction"):
+                    text = extract(html)
+            # 本体・抽出結果・ページの行は1つのトランザクションで書き、
+            # 書いている途中の本体を別プロセスの削除が消さないようにする
+            with storage.transaction(conn):
+                self._write_blob(conn, html)
+                if extracted: self._store_text(conn, html_hash, text)
+                conn.execute(
+                    "INSERT OR REPLACE INTO pages (url, html_hash, etag, last_modified, checked_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, html_hash, headers.get("ETag"), headers.get("Last-Modified"), now, now),
+                )
+                storage.count(conn, misses=1)
+                self._evict_locked(conn)
+            return text
+
+    # --- 容量を超えたら、最後に使われた時刻が古いページから削除する ---
+    def _evict_locked(self, conn):
+        total, = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        while total > self.max_bytes:
+            oldest = conn.execute("SELECT url FROM pages ORDER BY last_access LIMIT 1").fetchone()
+            if not oldest: break
+            conn.execute("DELETE FROM pages WHERE url = ?", oldest)
+            conn.execute("DELETE FROM extractions WHERE html_hash NOT IN (SELECT html_hash FROM pages)")
+            orphans = conn.execute(
+                "SELECT hash, size FROM blobs WHERE hash NOT IN (SELECT html_hash FROM pages) "
+                "AND hash NOT IN (SELECT text_hash FROM extractions)"
+            ).fetchall()
+            for digest, size in orphans:
+                conn.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+                try:
+                    os.remove(self._blob_path(digest))
+                except FileNotFoundError:
+                    pass
+                total -= size
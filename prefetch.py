@@ -0,0 +1,139 @@
+# -----------------------------------------------------------------
+# 次に押されそうなボタンの回答の先読み
+# 回答が届いたあと、深掘りの問いかけやキーワードの質問の回答をバックグラウンドで作っておき、
+# ボタンが押されたらすぐに表示する。同時実行数・全体の予算・セッションごとの予算・回答ごとの予算で量を抑え、
+# 別の質問をしたときや会話をリセットしたときは取り消す。
+# -----------------------------------------------------------------
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from answer_cache import normalize_question
+
+DEFAULT_WORKERS = 2
+DEFAULT_GLOBAL_TOKEN_BUDGET = 500_000
+# 1つの回答のあとに先読みする分の予算（履歴と資料の抜粋を含めると1件あたり1万トークン前後になる）
+DEFAULT_TURN_TOKEN_BUDGET = 40_000
+# 1つのセッションが1時間に先読みに使える分の予算（ボタンを押さずに質問を続けるセッションが全体の予算を使い切らないように）
+DEFAULT_SESSION_TOKEN_BUDGET = 150_000
+GLOBAL_BUDGET_WINDOW = 3600
+SESSION_BUDGET_WINDOW = 3600
+# 回答の長さは分からないため、予約するときは平均的な回答の長さを見込む
+EXPECTED_ANSWER_TOKENS = 800
+MAX_PREFETCH_PER_ANSWER = 3
+# 実行中の先読みは、この時間だけ待つ（待つより問い合わせ直す方が早くなる場合もあるため）
+TAKE_TIMEOUT = 10
+
+
+class Prefetcher:
+    def __init__(self, max_workers=DEFAULT_WORKERS, global_token_budget=DEFAULT_GLOBAL_TOKEN_BUDGET, budget_window=GLOBAL_BUDGET_WINDOW):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.global_token_budget = global_token_budget
+        self.budget_window = budget_window
+        self._lock = threading.Lock()
+        self._window_started = time.time()
+        self._window_tokens = 0
+        self._counters = {"submitted": 0, "hits": 0, "cancelled": 0, "failed": 0, "wasted": 0, "wasted_tokens": 0, "used_tokens": 0, "over_budget": 0}
+
+    def count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self._counters[name] += value
+
+    def _reserve(self, tokens):
+        with self._lock:
+            now = time.time()
+            if now - self._window_started >= self.budget_window:
+                self._window_started, self._window_tokens = now, 0
+            if self._window_tokens + tokens > self.global_token_budget:
+                self._counters["over_budget"] += 1
+                return False
+            self._window_tokens += tokens
+            return True
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._counters)
+        finished = result["hits"] + result["wasted"]
+        result["hit_rate"] = result["hits"] / finished if finished else 0.0
+        return result
+
+    def session(self, token_budget=DEFAULT_TURN_TOKEN_BUDGET, session_token_budget=DEFAULT_SESSION_TOKEN_BUDGET, budget_window=SESSION_BUDGET_WINDOW):
+        return PrefetchSession(self, token_budget, session_token_budget, budget_window)
+
+
+class PrefetchSession:
+    def __init__(self, prefetcher, token_budget, session_token_budget=DEFAULT_SESSION_TOKEN_BUDGET, budget_window=SESSION_BUDGET_WINDOW):
+        self.prefetcher = prefetcher
+        self.token_budget = token_budget
+        self.session_token_budget = session_token_budget
+        self.budget_window = budget_window
+        self.spent_tokens = 0
+        self._window_started = time.time()
+        self._window_tokens = 0
+        self._futures = {}
+
+    def start_turn(self):
+        # 回答ごとの予算は数え直す（前の回答の先読みは、新しい質問をした時点で取り消されている）。
+        # セッションごとの予算は、時間の区切りごとに数え直す
+        self.spent_tokens = 0
+
+    def _session_budget_left(self):
+        now = time.time()
+        if now - self._window_started >= self.budget_window:
+            self._window_started, self._window_tokens = now, 0
+        return self.session_token_budget - self._window_tokens
+
+    def submit(self, question, payload_tokens, call):
+        key = normalize_question(question)
+        if key in self._futures: return False
+        reserved = payload_tokens + EXPECTED_ANSWER_TOKENS
+        if self.spent_tokens + reserved > self.token_budget or reserved > self._session_budget_left():
+            self.prefetcher.count(over_budget=1)
+            return False
+        if not self.prefetcher._reserve(reserved): return False
+        self.spent_tokens += reserved
+        self._window_tokens += reserved
+        self._futures[key] = self.prefetcher._executor.submit(call)
+        self.prefetcher.count(submitted=1)
+        return True
+
+    def pending(self):
+        return sum(1 for future in self._futures.values() if not future.done())
+
+    def take(self, question, timeout=TAKE_TIMEOUT):
+        # 先読み済み（または先読み中）の回答があれば返す。実行中なら新しく問い合わせるより待つ方が早い。
+        # まだ始まっていない（他のセッションの先読みの後ろで順番待ちの）ものは取り消して、すぐに問い合わせる
+        future = self._futures.pop(normalize_question(question), None)
+        if future is None: return None
+        if not future.running() and not future.done():
+            self._discard(future)
+            return None
+        try:
+            result = future.result(timeout=timeout)
+        except TimeoutError:
+            self._discard(future)
+            return None
+        except Exception:
+            self.prefetcher.count(failed=1)
+            return None
+        self.prefetcher.count(hits=1, used_tokens=result["tokens"])
+        return result
+
+    def _discard(self, future):
+        if future.cancel():
+            self.prefetcher.count(cancelled=1)
+            return
+
+        def count_waste(done):
+            if done.exception() is None:
+                self.prefetcher.count(wasted=1, wasted_tokens=done.result()["tokens"])
+            else:
+                self.prefetcher.count(failed=1)
+        # 実行中のものは止められないため、終わった時点で無駄になったトークンとして数える
+        future.add_done_callback(count_waste)
+
+    def cancel(self):
+        futures, self._futures = self._futures, {}
+        for future in futures.values():
+            self._discard(future)
@@ -0,0 +1,55 @@
+# -----------------------------------------------------------------
+# AIの回答を表示用の部品（セグメント）に分解する
+# 回答が届いたときに一度だけ実行し、結果はメッセージと一緒に保存する
+# -----------------------------------------------------------------
+import json
+import re
+
+BLOCK_PATTERN = re.compile(r'(```json\n.*?\n```|```mermaid\n.*?\n```|\$\$.*?\$\$)', flags=re.DOTALL | re.IGNORECASE)
+SECTION_PATTERN = re.compile(r'(### (?:.*?)\n(?:.|\n)*?(?=\n###|\Z))')
+QUESTION_SECTION_WORDS = ("深掘り", "分岐点", "実験")
+KEYWORD_SECTION_WORDS = ("キーワード", "登場人物", "専門用語")
+
+
+def parse_sections(text):
+    segments = []
+    for sub_part in SECTION_PATTERN.split(text):
+        if not sub_part.strip(): continue
+        if not sub_part.strip().startswith("###"):
+            segments.append({"type": "markdown", "text": sub_part})
+            continue
+        title_match = re.search(r'### (.*?)\n', sub_part)
+        title = title_match.group(1).strip() if title_match else ""
+        content = sub_part[len(title)+5:].strip()
+        segments.append({"type": "heading", "text": title})
+        if any(word in title for word in QUESTION_SECTION_WORDS):
+            questions = [re.sub(r'^\d+\.\s*', '', q.strip()) for q in content.split('\n') if q.strip()]
+            segments.append({"type": "questions", "items": questions})
+        elif any(word in title for word in KEYWORD_SECTION_WORDS):
+            keywords = [kw.strip().lstrip('*- ').strip() for kw in content.split('\n') if kw.strip()]
+            segments.append({"type": "keywords", "items": [kw for kw in keywords if kw]})
+        else:
+            segments.append({"type": "markdown", "text": content})
+    return segments
+
+
+def parse_response(text):
+    segments = []
+    for part in BLOCK_PATTERN.split(text):
+        if not part.strip(): continue
+        part_lower = part.strip().lower()
+        if part_lower.startswith('```json'):
+            json_code = part.strip().lstrip('```json').rstrip('```')
+            try:
+                # 末尾の余分なカンマなど、よくある崩れを直してから読み込む
+                json_code = re.sub(r',\s*([}\]])', r'\1', json_code)
+                segments.append({"type": "vega", "spec": json.loads(json_code)})
+            except json.JSONDecodeError:
+                segments.append({"type": "invalid_json", "code": json_code})
+        elif part_lower.startswith('```mermaid'):
+            segments.append({"type": "mermaid", "code": part.strip()[len("```mermaid"):].rstrip('```').strip()})
+        elif part_lower.startswith('$$'):
+            segments.append({"type": "latex", "code": part.strip().strip('$$')})
+        else:
+            segments.extend(parse_sections(part))
+    return segments
@@ -0,0 +1,137 @@
+# -----------------------------------------------------------------
+# 参考文章の分割と検索（オフラインのBM25）
+# -----------------------------------------------------------------
+import math
+import re
+from collections import Counter
+
+DEFAULT_CHUNK_TOKENS = 300
+DEFAULT_TOP_K = 5
+DEFAULT_TOKEN_BUDGET = 2000
+
+# 日本語は形態素解析を使わず、漢字・かな・カナの文字bi-gramで索引する
+CJK_RUN = re.compile(r'[\u3005\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff66-\uff9f]+')
+WORD = re.compile(r'[0-9A-Za-z０-９Ａ-Ｚａ-ｚ]+')
+# 文の終わり（句点・感嘆符・疑問符のあと）
+SENTENCE_END = re.compile(r'(?<=[。！？!?])|(?<=\.)(?=\s)')
+
+
+def estimate_tokens(text):
+    # Geminiのトークン数の概算：全角文字は1文字≒1トークン、半角は4文字≒1トークン
+    if not text: return 0
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_chars) + math.ceil(ascii_chars / 4)
+
+
+def tokenize(text):
+    terms = [w.lower() for w in WORD.findall(text)]
+    for run in CJK_RUN.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def truncate_to_tokens(text, max_tokens):
+    # 先頭から max_tokens に収まるところまでを返す
+    used = 0
+    for i, c in enumerate(text):
+        used += 0.25 if c.isascii() else 1
+        if used > max_tokens: return text[:i]
+    return text
+
+
+def split_long_text(text, chunk_tokens):
+    # 改行のない長い段落は文ごとに、文も長すぎる場合は一定の長さで区切る
+    pieces = []
+    for sentence in (s for s in SENTENCE_END.split(text) if s.strip()):
+        while estimate_tokens(sentence) > chunk_tokens:
+            head = truncate_to_tokens(sentence, chunk_tokens) or sentence[:1]
+            pieces.append(head)
+            sentence = sentence[len(head):]
+        if sentence.strip(): pieces.append(sentence)
+    return pieces
+
+
+def split_into_chunks(text, chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    # 見出し（#）や空行で区切られた段落を、chunk_tokens を超えない範囲でまとめる
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n|\n(?=#)', text) if p.strip()]
+    chunks, current, current_tokens = [], [], 0
+    for paragraph in paragraphs:
+        paragraph_tokens = estimate_tokens(paragraph)
+        starts_section = paragraph.startswith("#")
+        if current and (starts_section or current_tokens + paragraph_tokens > chunk_tokens):
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        # 1段落だけで上限を超える場合は行単位で、1行でも超える場合は文単位でさらに分ける
+        if paragraph_tokens > chunk_tokens:
+            for line in paragraph.split("\n"):
+                separator = "\n"
+                for piece in (split_long_text(line, chunk_tokens) if estimate_tokens(line) > chunk_tokens else [line]):
+                    piece_tokens = estimate_tokens(piece)
+                    if current and current_tokens + piece_tokens > chunk_tokens:
+                        chunks.append("".join(current))
+                        current, current_tokens = [], 0
+                    current.append(piece if not current else separator + piece)
+                    current_tokens += piece_tokens
+                    separator = ""
+            if current:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            continue
+        current.append(paragraph)
+        current_tokens += paragraph_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+class DocumentIndex:
+    def __init__(self, text, chunk_tokens=DEFAULT_CHUNK_TOKENS, k1=1.5, b=0.75):
+        self.chunks = split_into_chunks(text, chunk_tokens)
+        self.chunk_tokens = [estimate_tokens(c) for c in self.chunks]
+        self.total_tokens = sum(self.chunk_tokens)
+        self.k1, self.b = k1, b
+        self.term_freqs = [Counter(tokenize(c)) for c in self.chunks]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        document_freq = Counter()
+        for tf in self.term_freqs:
+            document_freq.update(tf.keys())
+        n = len(self.chunks)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_freq.items()}
+
+    def search(self, query, top_k=DEFAULT_TOP_K):
+        query_terms = set(tokenize(query)) & self.idf.keys()
+        scores = []
+        for i, tf in enumerate(self.term_freqs):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / (self.avg_length or 1))
+            for term in query_terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((score, i))
+        scores.sort(key=lambda item: (-item[0], item[1]))
+        return scores[:top_k]
+
+    def select_context(self, query, top_k=DEFAULT_TOP_K, token_budget=DEFAULT_TOKEN_BUDGET):
+        # 文章全体が予算内に収まるなら、そのまま全文を使う
+        if self.total_tokens <= token_budget:
+            return "\n\n".join(self.chunks)
+        hits = self.search(query, top_k)
+        # 質問に一致する部分がない場合は冒頭部分（概要であることが多い）を使う
+        candidates = [i for _, i in hits] or list(range(len(self.chunks)))
+        selected, used = [], 0
+        for i in candidates:
+            if used + self.chunk_tokens[i] > token_budget: continue
+            selected.append(i)
+            used += self.chunk_tokens[i]
+            if len(selected) >= top_k: break
+        # どれも予算に収まらない場合も空にはせず、最も関連する部分を予算まで切り詰めて渡す
+        if not selected and candidates:
+            return truncate_to_tokens(self.chunks[candidates[0]], token_budget)
+        # 元の文章の順序で並べ直して渡す
+        return "\n\n...\n\n".join(self.chunks[i] for i in sorted(selected))
@@ -0,0 +1,202 @@
+# -----------------------------------------------------------------
+# セッションの状態の保存先
+# 会話の状態を Streamlit のプロセスの外に置き、再接続したときや別のプロセスに振り分けられたときに
+# 読み込み直せるようにする。Gemini のチャットは保存せず、読み込んだメッセージから作り直す。
+#   AI_TUTOR_SESSION_BACKEND=sqlite（既定）: state/sessions.sqlite3（同じディスクを共有するプロセス間で使える）
+#   AI_TUTOR_SESSION_BACKEND=file          : state/sessions/ 以下に1セッション1ファイル
+#   AI_TUTOR_SESSION_BACKEND=redis         : AI_TUTOR_REDIS_URL の Redis（redis-py が必要）
+#   AI_TUTOR_SESSION_BACKEND=none          : 保存しない（以前と同じ）
+# ほかの key-value ストアも、get / put / delete / contains の4つを実装すれば使える（期限の延長 touch は get と put で行う）。
+# -----------------------------------------------------------------
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+
+import storage
+
+DEFAULT_STATE_DIR = os.environ.get("AI_TUTOR_STATE_DIR", "state")
+# 最後に使われてからこの時間が過ぎたセッションは消す
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+SESSION_PREFIX = "session:"
+DOCUMENT_PREFIX = "document:"
+
+
+def encode_state(state):
+    return zlib.compress(json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_state(data):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+class SessionBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, data, ttl=DEFAULT_TTL_SECONDS):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def contains(self, key):
+        return self.get(key) is not None
+
+    def touch(self, key, ttl=DEFAULT_TTL_SECONDS):
+        # 期限を今から ttl 後に延ばす。期限切れなどで見つからなければ False
+        data = self.get(key)
+        if data is None: return False
+        self.put(key, data, ttl)
+        return True
+
+    # --- セッションの状態 ---
+    def load_session(self, session_id):
+        data = self.get(SESSION_PREFIX + session_id)
+        return decode_state(data) if data else None
+
+    def save_session(self, session_id, state):
+        self.put(SESSION_PREFIX + session_id, encode_state(state))
+
+    def delete_session(self, session_id):
+        self.delete(SESSION_PREFIX + session_id)
+
+    # --- 資料の本文（内容のハッシュで1つだけ保存し、セッション同士で共有する） ---
+    def load_document(self, digest):
+        data = self.get(DOCUMENT_PREFIX + digest)
+        return zlib.decompress(data).decode("utf-8") if data else None
+
+    def save_document(self, digest, text):
+        # 保存済みなら期限だけ延ばす。セッションを保存するたびに呼ばれるので、
+        # 資料を参照しているセッションより先に資料が消えることはない
+        if not self.touch(DOCUMENT_PREFIX + digest):
+            self.put(DOCUMENT_PREFIX + digest, zlib.compress(text.encode("utf-8")))
+
+
+class SQLiteSessionBackend(SessionBackend):
+    name = "sqlite"
+
+    def __init__(self, path=os.path.join(DEFAULT_STATE_DIR, "sessions.sqlite3")):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS state_expires_at ON state (expires_at)")
+
+    def _connect(self):
+        return storage.connect(self.path)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM state WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, data, ttl=DEFAULT_TTL_SECONDS):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO state (key, data, expires_at) VALUES (?, ?, ?)", (key, data, now + ttl))
+            conn.execute("DELETE FROM state WHERE expires_at <= ?", (now,))
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def contains(self, key):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM state WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone() is not None
+
+    def touch(self, key, ttl=DEFAULT_TTL_SECONDS):
+        now = time.time()
+        with self._connect() as conn:
+            return conn.execute("UPDATE state SET expires_at = ? WHERE key = ? AND expires_at > ?", (now + ttl, key, now)).rowcount > 0
+
+
+class FileSessionBackend(SessionBackend):
+    name = "file"
+
+    def __init__(self, root=os.path.join(DEFAULT_STATE_DIR, "sessions")):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.purge_expired()
+
+    def purge_expired(self):
+        now = time.time()
+        for filename in os.listdir(self.root):
+            path = os.path.join(self.root, filename)
+            try:
+                with open(path, "rb") as f:
+                    expired = float(f.readline()) <= now
+                if expired: os.remove(path)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def _path(self, key):
+        # キーにはURLなど任意の文字が入りうるため、ファイル名にはハッシュを使う
+        return os.path.join(self.root, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires_at = float(f.readline())
+                if expires_at <= time.time(): return None
+                return f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key, data, ttl=DEFAULT_TTL_SECONDS):
+        # 書きかけのファイルを他のプロセスが読まないよう、一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, "wb") as f:
+            f.write(f"{time.time() + ttl}\n".encode("ascii"))
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class RedisSessionBackend(SessionBackend):
+    name = "redis"
+
+    def __init__(self, client, prefix="ai-tutor:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def put(self, key, data, ttl=DEFAULT_TTL_SECONDS):
+        self.client.set(self.prefix + key, data, ex=int(ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def contains(self, key):
+        return bool(self.client.exists(self.prefix + key))
+
+    def touch(self, key, ttl=DEFAULT_TTL_SECONDS):
+        return bool(self.client.expire(self.prefix + key, int(ttl)))
+
+
+def selected_session_backend_name():
+    return os.environ.get("AI_TUTOR_SESSION_BACKEND", "sqlite")
+
+
+def create_session_backend(name=None):
+    name = name or selected_session_backend_name()
+    if name == "none":
+        return None
+    if name == "sqlite":
+        return SQLiteSessionBackend()
+    if name == "file":
+        return FileSessionBackend()
+    if name == "redis":
+        import redis
+        return RedisSessionBackend(redis.Redis.from_url(os.environ.get("AI_TUTOR_REDIS_URL", "redis://localhost:6379/0")))
+    raise ValueError(f"unknown session backend: {name}")
@@ -0,0 +1,65 @@
+# -----------------------------------------------------------------
+# 保存先の共通部品（SQLite）
+# 回答キャッシュ・ページキャッシュ・会話履歴・知識ノート・セッションの状態で共通の、
+# 保存先のディレクトリの設定、WAL モードの接続、書き込みのロックを先に取るトランザクション、
+# stats テーブルに回数を数える処理をまとめる。
+#   AI_TUTOR_CACHE_DIR=cache  : ページキャッシュと回答キャッシュ（全セッション・全プロセスで共有）
+# -----------------------------------------------------------------
+import contextlib
+import os
+import sqlite3
+
+CACHE_DIR = os.environ.get("AI_TUTOR_CACHE_DIR", "cache")
+# 他のプロセスが書き込み中のとき、待つ秒数
+BUSY_TIMEOUT = 30
+
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+@contextlib.contextmanager
+def connect(path, autocommit=False, foreign_keys=False):
+    # 接続はスレッドやプロセスをまたいで共有せず、呼び出しごとに開いて閉じる。
+    # autocommit=False : with を抜けるときにまとめてコミットする（例外ならロールバック）
+    # autocommit=True  : 1文ごとに確定する（キャッシュ用。まとめて書くときは transaction で囲む）
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None if autocommit else "")
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        if autocommit: conn.execute("PRAGMA synchronous=NORMAL")
+        if foreign_keys: conn.execute("PRAGMA foreign_keys=ON")
+        if autocommit:
+            yield conn
+        else:
+            with conn:
+                yield conn
+    finally:
+        conn.close()
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    # autocommit の接続で使う。書き込みのロックを先に取り、他のプロセスの書き込みと交互に実行されないようにする
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def count(conn, **increments):
+    for name, value in increments.items():
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, value),
+        )
+
+
+def counters(conn):
+    return dict(conn.execute("SELECT name, value FROM stats"))
@@ -0,0 +1,31 @@
+# -----------------------------------------------------------------
+# 学習者ごとの知識ノート（knowledge）のテスト
+#   python -m pytest tests
+# -----------------------------------------------------------------
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge import KnowledgeIndex
+
+
+def test_purges_only_stale_anonymous_learners(tmp_path):
+    path = str(tmp_path / "knowledge.sqlite3")
+    knowledge = KnowledgeIndex(path=path, anonymous_ttl=3600)
+    old = time.time() - 7200
+    knowledge.record("session:old", "光合成", seen_at=old)
+    knowledge.record("session:old", "葉緑体", related=["光合成"], seen_at=old)
+    knowledge.record("session:new", "光合成")
+    knowledge.record("たろう", "光合成", seen_at=old)
+
+    assert knowledge.purge_anonymous() == 1
+    assert knowledge.count("session:old") == 0
+    assert knowledge.count("session:new") == 1
+    # 名前のある学習者のノートは、古くても消さない
+    assert knowledge.count("たろう") == 1
+    with sqlite3.connect(path) as conn:
+        for table in ("links", "keyword_terms"):
+            assert conn.execute(f"SELECT COUNT(*) FROM {table} WHERE learner = 'session:old'").fetchone()[0] == 0
@@ -0,0 +1,99 @@
+# -----------------------------------------------------------------
+# LLM呼び出しの関所（llm_gateway）のテスト
+#   python -m pytest tests
+# -----------------------------------------------------------------
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_gateway import LLMGateway, GatewayBackend, QueueTimeout, StreamTimeout
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class StalledResponse:
+    # 最初の断片のあと、長い間止まる応答
+    usage_metadata = None
+
+    def __init__(self, stall_seconds):
+        self.stall_seconds = stall_seconds
+
+    def __iter__(self):
+        yield Chunk("はじめの部分 ")
+        time.sleep(self.stall_seconds)
+        yield Chunk("続き")
+
+
+class TextResponse:
+    usage_metadata = None
+    text = "回答"
+
+
+class StubModel:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+        self.backend.request_options.append(request_options)
+        return StalledResponse(self.backend.stall_seconds) if stream else TextResponse()
+
+
+class StubBackend:
+    name = "stub"
+
+    def __init__(self, stall_seconds):
+        self.stall_seconds = stall_seconds
+        self.request_options = []
+
+    def model(self, system_instruction=None):
+        return StubModel(self)
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_stalled_stream_releases_slot_and_times_out_reader():
+    gateway = LLMGateway(max_concurrency=1, stream_timeout=0.5, queue_timeout=3)
+    backend = GatewayBackend(StubBackend(stall_seconds=5), gateway)
+    started = time.monotonic()
+    response = backend.model(session="a").generate_content("止まる質問", stream=True)
+    wait_until(lambda: gateway.stats()["running"] == 1)
+
+    # 止まった応答が枠を持ち続けず、別のセッションの呼び出しが通る
+    assert backend.model(session="b").generate_content("別の質問").text == "回答"
+    assert time.monotonic() - started < 2
+    assert gateway.stats()["running"] == 0
+    assert gateway.stats()["timeouts"] == 1
+
+    # 読み手も止まらずに時間切れを受け取る
+    with pytest.raises(StreamTimeout):
+        list(response)
+    assert time.monotonic() - started < 2
+
+
+def test_stream_passes_request_timeout_to_backend():
+    stub = StubBackend(stall_seconds=0)
+    backend = GatewayBackend(stub, LLMGateway(stream_timeout=7))
+    backend.model().generate_content("質問", stream=True).text
+    assert stub.request_options == [{"timeout": 7}]
+
+
+def test_queue_timeout_when_slot_is_held():
+    gateway = LLMGateway(max_concurrency=1, stream_timeout=5, queue_timeout=0.3)
+    backend = GatewayBackend(StubBackend(stall_seconds=2), gateway)
+    backend.model(session="a").generate_content("止まる質問", stream=True)
+    # ストリームは別スレッドで枠を取るため、取り終えるまで待つ
+    wait_until(lambda: gateway.stats()["running"] == 1)
+    with pytest.raises(QueueTimeout):
+        backend.model(session="b").generate_content("別の質問")
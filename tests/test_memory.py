@@ -0,0 +1,56 @@
+# -----------------------------------------------------------------
+# 会話の記憶（memory）のテスト
+#   python -m pytest tests
+# -----------------------------------------------------------------
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobs import JobExecutor
+from memory import ConversationMemory
+
+
+def conversation(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"質問{i}"})
+        messages.append({"role": "model", "content": f"回答{i}"})
+    return messages
+
+
+def test_folds_in_batches():
+    prompts = []
+    memory = ConversationMemory(keep_turns=2, summarize=lambda prompt: prompts.append(prompt) or "要約", fold_batch=3)
+    for turns in range(1, 9):
+        memory.history(conversation(turns))
+    # あふれたやりとりが3件たまるごとに1回だけ要約する
+    assert len(prompts) == 2
+    assert memory.summarized_turns == 6
+    assert memory.last_stats["verbatim_turns"] == 2
+
+
+def test_background_fold_does_not_block_history():
+    release = threading.Event()
+
+    def summarize(prompt):
+        release.wait(5)
+        return "AIの要約"
+
+    memory = ConversationMemory(keep_turns=1, summarize=summarize, executor=JobExecutor(), fold_batch=2)
+    started = time.monotonic()
+    history = memory.history(conversation(3))
+    assert time.monotonic() - started < 1
+    # 要約の実行中は、抜き書きの要約で代わりにする
+    assert "質問0" in history[0]["parts"][0]
+    assert memory.summarized_turns == 0
+
+    release.set()
+    for _ in range(50):
+        memory.history(conversation(3))
+        if memory.summarized_turns: break
+        time.sleep(0.05)
+    assert memory.summary == "AIの要約"
+    assert memory.summarized_turns == 2
@@ -0,0 +1,34 @@
+# -----------------------------------------------------------------
+# 処理時間の計測と集計（metrics）のテスト
+#   python -m pytest tests
+# -----------------------------------------------------------------
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_second_process_uses_next_port_or_skips():
+    port = free_port()
+    first = metrics.start_server(f"{port}-{port + 1}")
+    try:
+        assert first.server_address[1] == port
+        # 同じポートを指定した別のプロセスは、範囲内の次のポートを使う
+        second = metrics.start_server(f"{port}-{port + 1}")
+        assert second.server_address[1] == port + 1
+        second.shutdown()
+        second.server_close()
+        # 空きがなければ例外にせず、公開しないだけ
+        assert metrics.start_server(str(port)) is None
+    finally:
+        first.shutdown()
+        first.server_close()
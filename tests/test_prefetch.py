@@ -0,0 +1,38 @@
+# -----------------------------------------------------------------
+# 次に押されそうなボタンの回答の先読み（prefetch）のテスト
+#   python -m pytest tests
+# -----------------------------------------------------------------
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefetch import Prefetcher, EXPECTED_ANSWER_TOKENS
+
+
+def answer():
+    return {"text": "回答", "tokens": 10}
+
+
+def test_session_budget_spans_turns_until_window_resets():
+    session = Prefetcher().session(token_budget=10_000, session_token_budget=3 * (1000 + EXPECTED_ANSWER_TOKENS))
+    submitted = []
+    for turn in range(3):
+        session.start_turn()
+        submitted += [session.submit(f"質問{turn}-{i}", 1000, answer) for i in range(2)]
+    # 回答ごとの予算には収まっても、セッションの予算を超えた分は先読みしない
+    assert submitted.count(True) == 3
+    assert session.prefetcher.stats()["over_budget"] == 3
+
+    # 時間の区切りが過ぎたら、また先読みできる
+    session._window_started -= session.budget_window
+    session.start_turn()
+    assert session.submit("新しい質問", 1000, answer)
+
+
+def test_turn_budget_caps_each_answer():
+    session = Prefetcher().session(token_budget=2 * (1000 + EXPECTED_ANSWER_TOKENS))
+    session.start_turn()
+    assert [session.submit(f"質問{i}", 1000, answer) for i in range(3)] == [True, True, False]
+    session.start_turn()
+    assert session.submit("次の質問", 1000, answer)
@@ -0,0 +1,36 @@
+# -----------------------------------------------------------------
+# セッションの状態の保存先（session_backend）のテスト
+#   python -m pytest tests
+# -----------------------------------------------------------------
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_backend import DOCUMENT_PREFIX, FileSessionBackend, SQLiteSessionBackend
+
+
+@pytest.fixture(params=["sqlite", "file"])
+def backend(request, tmp_path):
+    if request.param == "sqlite": return SQLiteSessionBackend(path=str(tmp_path / "sessions.sqlite3"))
+    return FileSessionBackend(root=str(tmp_path / "sessions"))
+
+
+def test_saving_a_session_refreshes_its_document(backend):
+    backend.put(DOCUMENT_PREFIX + "abc", b"x", ttl=0.5)
+    # 資料を参照するセッションを保存するたびに、資料の期限も延びる
+    backend.save_document("abc", "本文")
+    time.sleep(0.6)
+    assert backend.contains(DOCUMENT_PREFIX + "abc")
+    # 期限を延ばすだけで、中身は書き換えない
+    assert backend.get(DOCUMENT_PREFIX + "abc") == b"x"
+
+
+def test_expired_document_is_saved_again(backend):
+    backend.put(DOCUMENT_PREFIX + "abc", b"x", ttl=0.1)
+    time.sleep(0.2)
+    backend.save_document("abc", "本文")
+    assert backend.load_document("abc") == "本文"